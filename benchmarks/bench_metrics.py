@@ -0,0 +1,34 @@
+import numpy as np
+import torch
+
+from metrics import StreamSegMetrics
+
+from .common import measure
+
+
+def run(batch_size=4, size=(768, 768), num_classes=19, runs=10):
+    """Throughput of ``StreamSegMetrics.update`` for numpy label maps and for tensors
+    (on the GPU when available), and the cost of ``get_results``.
+    """
+    rng = np.random.RandomState(0)
+    labels = rng.randint(0, num_classes, (batch_size,) + tuple(size))
+    labels[:, :8] = 255  # some ignored pixels, as in real targets
+    preds = rng.randint(0, num_classes, (batch_size,) + tuple(size))
+    pixels = labels.size
+    metrics = StreamSegMetrics(num_classes)
+
+    results = {}
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    inputs = {
+        'update_numpy': (labels, preds),
+        'update_tensor_%s' % device.type: (torch.from_numpy(labels).to(device), torch.from_numpy(preds).to(device)),
+    }
+    for name, (label_trues, label_preds) in inputs.items():
+        metrics.reset()
+        result = measure(lambda: metrics.update(label_trues, label_preds), runs)
+        result['megapixels_per_sec'] = pixels / result['mean_ms'] / 1000
+        results[name] = result
+        print("%-24s %8.1f Mpixels/s" % (name, result['megapixels_per_sec']))
+    results['get_results'] = measure(metrics.get_results, runs)
+    print("%-24s %8.3f ms" % ('get_results', results['get_results']['mean_ms']))
+    return results
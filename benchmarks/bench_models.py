@@ -0,0 +1,89 @@
+import copy
+
+import torch
+import torch.fx
+
+import network
+
+from .common import measure
+
+
+def available_models():
+    """ the model constructors of network.modeling, as listed by main.py """
+    return sorted(name for name in network.modeling.__dict__ if name.islower() and
+                  not (name.startswith("__") or name.startswith('_')) and
+                  callable(network.modeling.__dict__[name]))
+
+
+MEMORY_FORMATS = {'contiguous': torch.contiguous_format, 'channels_last': torch.channels_last}
+
+
+def fx_trace_error(model):
+    """ None if the inference forward of ``model`` is traceable by torch.fx, as needed by
+    ``network.quantize_for_inference``, the error message otherwise
+    """
+    try:
+        torch.fx.symbolic_trace(copy.deepcopy(model).eval().set_inference(True))
+    except Exception as e:
+        return '%s: %s' % (type(e).__name__, e)
+    return None
+
+
+def run(models=None, output_strides=(8, 16), batch_size=2, input_size=(768, 768), runs=3, num_classes=19,
+        memory_formats=('contiguous', 'channels_last')):
+    """Forward latency (eval mode, no grad) and forward + backward latency (train mode)
+    of every model constructor at each output stride, on random inputs. HRNet models
+    ignore ``output_stride`` and are timed at each value all the same. Train mode needs
+    ``batch_size`` > 1 for the BatchNorm after the ASPP pooling.
+
+    Each model is timed with its weights and inputs in every format of ``memory_formats``
+    (``contiguous`` NCHW, ``channels_last`` NHWC), the results of channels-last are keyed
+    ``<model>/os<stride>/channels_last``. Every model is also traced with torch.fx in
+    each format, a model that cannot be traced (and thus not quantized) is reported.
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    results = {}
+    for name in models or available_models():
+        for output_stride in output_strides:
+            key = '%s/os%d' % (name, output_stride)
+            for memory_format in memory_formats:
+                format_key = key if memory_format == 'contiguous' else '%s/%s' % (key, memory_format)
+                try:
+                    model = network.modeling.__dict__[name](num_classes=num_classes, output_stride=output_stride,
+                                                            pretrained_backbone=False).to(device)
+                except Exception as e:  # a constructor that cannot be built should not stop the suite
+                    results[key] = {'error': str(e)}
+                    print("%-48s failed: %s" % (key, e))
+                    break
+                if memory_format == 'channels_last':
+                    model = network.convert_to_channels_last(model)
+                images = torch.randn(batch_size, 3, *input_size, device=device).contiguous(
+                    memory_format=MEMORY_FORMATS[memory_format])
+
+                model.eval()
+                with torch.no_grad():
+                    forward = measure(lambda model=model, images=images: model(images), runs)
+
+                model.train()
+
+                def step(model=model, images=images):
+                    model.zero_grad(set_to_none=True)
+                    outputs, _ = model(images)
+                    outputs.mean().backward()
+                train = measure(step, runs)
+
+                trace_error = fx_trace_error(model)
+                results[format_key] = {'forward': forward, 'forward_backward': train,
+                                       'batch_size': batch_size, 'input_size': list(input_size),
+                                       'memory_format': memory_format, 'fx_trace_error': trace_error,
+                                       'parameters': sum(p.numel() for p in model.parameters())}
+                print("%-48s forward %8.1f ms, forward+backward %8.1f ms" %
+                      (format_key, forward['mean_ms'], train['mean_ms']))
+                if trace_error is not None:
+                    print("%-48s [!] not traceable by torch.fx: %s" % (format_key, trace_error))
+            if key in results and '%s/channels_last' % key in results:
+                last = results['%s/channels_last' % key]
+                print("%-48s channels_last speedup: forward %.2fx, forward+backward %.2fx" % (
+                    key, results[key]['forward']['mean_ms'] / last['forward']['mean_ms'],
+                    results[key]['forward_backward']['mean_ms'] / last['forward_backward']['mean_ms']))
+    return results
@@ -0,0 +1,93 @@
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+from torch.utils import data
+
+import main
+import network
+import utils
+
+from .common import write_synthetic_gta
+
+
+def run(model_name='deeplabv3plus_mobilenet', output_stride=16, batch_size=2, iterations=5, warmup=1,
+        num_workers=2, data_root=None, extra_args=()):
+    """Iterations/sec of the ``main.py`` training loop on synthetic GTA5 data.
+
+    The dataset, augmentation and loader are those of ``main.get_dataset`` for
+    ``--dataset cityscapes``, with the options of ``extra_args`` (e.g.
+    ``['--batch_transforms']`` or ``['--channels_last']``). Time spent waiting for the
+    loader is reported apart from the forward, backward and optimizer step.
+    """
+    tmp = None
+    if data_root is None:
+        tmp = tempfile.TemporaryDirectory()
+        data_root = write_synthetic_gta(tmp.name, num_images=batch_size * (iterations + warmup))
+    opts = main.get_argparser().parse_args(['--dataset', 'cityscapes', '--data_root', data_root,
+                                            '--model', model_name, '--output_stride', str(output_stride),
+                                            '--batch_size', str(batch_size)] + list(extra_args))
+    opts.num_classes = 19
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    train_dst, _ = main.get_dataset(opts)
+    batch_transform = main.get_batch_transform(opts)
+    loader = data.DataLoader(train_dst, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                             drop_last=True, collate_fn=utils.channels_last_collate if opts.channels_last else None)
+    model = network.modeling.__dict__[model_name](num_classes=opts.num_classes, output_stride=output_stride,
+                                                  pretrained_backbone=False)
+    memory_format = torch.channels_last if opts.channels_last else torch.preserve_format
+    if opts.channels_last:
+        model = network.convert_to_channels_last(model)
+    utils.set_bn_momentum(model.backbone, momentum=0.01)
+    model = nn.DataParallel(model.to(device))
+    optimizer = torch.optim.SGD(params=[
+        {'params': model.module.backbone.parameters(), 'lr': 0.1 * opts.lr},
+        {'params': model.module.classifier.parameters(), 'lr': opts.lr},
+    ], lr=opts.lr, momentum=0.9, weight_decay=opts.weight_decay)
+    scheduler = utils.PolyLR(optimizer, opts.total_itrs, power=0.9)
+    criterion = nn.CrossEntropyLoss(ignore_index=255, reduction='mean')
+    model.train()
+
+    data_time = step_time = 0.0
+    done = 0
+    start = None
+    while done < iterations + warmup:
+        fetch = time.perf_counter()
+        for images, labels in loader:
+            if done == warmup:
+                start = fetch = time.perf_counter()
+                data_time = step_time = 0.0
+            if batch_transform is not None:
+                images, labels = batch_transform(images.to(device), labels.to(device))
+            images = images.to(device, dtype=torch.float32, memory_format=memory_format)
+            labels = labels.to(device, dtype=torch.long)
+            begin = time.perf_counter()
+            data_time += begin - fetch
+
+            optimizer.zero_grad()
+            outputs, _ = model(images)
+            loss = criterion(outputs, labels)
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            loss.item()  # wait for the step, as the loss logging of main.py does
+
+            fetch = time.perf_counter()
+            step_time += fetch - begin
+            done += 1
+            if done == iterations + warmup:
+                break
+    elapsed = time.perf_counter() - start
+    if tmp is not None:
+        tmp.cleanup()
+
+    result = {'iterations_per_sec': iterations / elapsed, 'images_per_sec': iterations * batch_size / elapsed,
+              'data_ms_per_iteration': 1000 * data_time / iterations,
+              'step_ms_per_iteration': 1000 * step_time / iterations,
+              'model': model_name, 'output_stride': output_stride, 'batch_size': batch_size,
+              'iterations': iterations, 'num_workers': num_workers, 'extra_args': list(extra_args)}
+    print("train loop: %.3f it/s (data %.1f ms, step %.1f ms per iteration)" %
+          (result['iterations_per_sec'], result['data_ms_per_iteration'], result['step_ms_per_iteration']))
+    return result
@@ -0,0 +1,95 @@
+import time
+
+import torch
+
+from datasets import GTA
+from utils import ext_transforms as et
+
+from .common import synthetic_pair
+
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def get_pipelines(crop_size=768):
+    """ the augmentation pipelines of main.get_dataset and main.get_batch_transform """
+    return {
+        'cityscapes_train': et.ExtCompose([
+            et.ExtResize(size=(1914, 1052)),
+            et.ExtRandomCrop(size=(crop_size, crop_size)),
+            et.ExtRandomHorizontalFlip(),
+            et.ExtToTensor(),
+            et.ExtNormalize(mean=MEAN, std=STD),
+        ]),
+        'cityscapes_val': et.ExtCompose([
+            et.ExtResize((crop_size, crop_size)),
+            et.ExtToTensor(),
+            et.ExtNormalize(mean=MEAN, std=STD),
+        ]),
+        'voc_train': et.ExtCompose([
+            et.ExtRandomScale((0.5, 2.0)),
+            et.ExtRandomCrop(size=(513, 513), pad_if_needed=True),
+            et.ExtRandomHorizontalFlip(),
+            et.ExtToTensor(),
+            et.ExtNormalize(mean=MEAN, std=STD),
+        ]),
+        'voc_val': et.ExtCompose([
+            et.ExtToTensor(),
+            et.ExtNormalize(mean=MEAN, std=STD),
+        ]),
+    }
+
+
+def get_batch_pipeline(crop_size=768):
+    return et.ExtBatchCompose([
+        et.ExtBatchResize(size=(1914, 1052)),
+        et.ExtBatchRandomCrop(size=(crop_size, crop_size)),
+        et.ExtBatchRandomHorizontalFlip(),
+        et.ExtBatchNormalize(mean=MEAN, std=STD),
+    ])
+
+
+def _images_per_sec(fn, num_images, warmup=1):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(num_images):
+        fn()
+    elapsed = time.perf_counter() - start
+    return {'images_per_sec': num_images / elapsed, 'ms_per_image': 1000 * elapsed / num_images,
+            'images': num_images}
+
+
+def run(num_images=20, batch_size=4, crop_size=768):
+    """Images/sec of every ``ext_transforms`` pipeline on GTA5-sized PIL inputs.
+
+    ``encode_target`` is timed on its own, as the GTA dataset applies it after the
+    transforms. ``batch_cityscapes_train`` is the ``--batch_transforms`` path: uint8
+    conversion per sample, then the batched transforms on ``batch_size`` images.
+    """
+    image, label = synthetic_pair()
+    results = {}
+    for name, transform in get_pipelines(crop_size).items():
+        results[name] = _images_per_sec(lambda: transform(image, label), num_images)
+        print("%-24s %8.2f images/s" % (name, results[name]['images_per_sec']))
+
+    to_tensor = et.ExtPILToTensor()
+    batch_transform = get_batch_pipeline(crop_size)
+
+    def batch_step():
+        pairs = [to_tensor(image, label) for _ in range(batch_size)]
+        imgs = torch.stack([p[0] for p in pairs])
+        lbls = torch.stack([p[1] for p in pairs])
+        batch_transform(imgs, lbls)
+    num_batches = max(num_images // batch_size, 1)
+    result = _images_per_sec(batch_step, num_batches)
+    result = {'images_per_sec': result['images_per_sec'] * batch_size,
+              'ms_per_image': result['ms_per_image'] / batch_size,
+              'images': num_batches * batch_size, 'batch_size': batch_size}
+    results['batch_cityscapes_train'] = result
+    print("%-24s %8.2f images/s" % ('batch_cityscapes_train', result['images_per_sec']))
+
+    results['encode_target'] = _images_per_sec(lambda: GTA.encode_target(label), num_images)
+    print("%-24s %8.2f images/s" % ('encode_target', results['encode_target']['images_per_sec']))
+    return results
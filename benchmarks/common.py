@@ -0,0 +1,83 @@
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+# (width, height) of the GTA5 frames, and number of raw label ids of GTA5 / Cityscapes
+GTA_SIZE = (1914, 1052)
+NUM_RAW_IDS = 34
+
+
+def synthetic_pair(seed=0, size=GTA_SIZE):
+    """ RGB image and raw label id map shaped like a GTA5 frame. Labels are blocks of
+    ids 0-33 so that PNG encoding and decoding cost is closer to real label maps than noise.
+    """
+    rng = np.random.RandomState(seed)
+    w, h = size
+    blocks = rng.randint(0, NUM_RAW_IDS, (h // 32 + 1, w // 32 + 1)).astype(np.uint8)
+    label = np.repeat(np.repeat(blocks, 32, axis=0), 32, axis=1)[:h, :w]
+    colors = rng.randint(0, 256, (NUM_RAW_IDS, 3)).astype(np.int16)
+    image = colors[label] + rng.randint(-20, 21, (h, w, 3))
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)), Image.fromarray(label)
+
+
+def write_synthetic_gta(root, num_images, size=GTA_SIZE):
+    """ GTA directory layout (ColorIds / LabelIds, train / val / test) under ``root``,
+    with ``num_images`` training pairs and one pair in val and test
+    """
+    counts = {'train': num_images, 'val': 1, 'test': 1}
+    for split, count in counts.items():
+        for folder in ['ColorIds', 'LabelIds']:
+            os.makedirs(os.path.join(root, folder, split), exist_ok=True)
+        for i in range(count):
+            image, label = synthetic_pair(seed=i, size=size)
+            image.save(os.path.join(root, 'ColorIds', split, '%05d.png' % i))
+            label.save(os.path.join(root, 'LabelIds', split, '%05d.png' % i))
+    return root
+
+
+def measure(fn, runs, warmup=1):
+    """ wall time of ``fn()`` in ms over ``runs`` calls, after ``warmup`` untimed ones """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'mean_ms': float(np.mean(times)), 'std_ms': float(np.std(times)),
+            'min_ms': float(np.min(times)), 'runs': runs}
+
+
+def environment():
+    """ what the numbers depend on, stored next to them """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+    }
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results saved as %s" % path)
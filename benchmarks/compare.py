@@ -0,0 +1,44 @@
+import argparse
+import json
+
+
+def flatten(results, prefix=''):
+    """ {'models/x/os16/forward/mean_ms': value, ...} of the timings and throughputs """
+    flat = {}
+    for key, value in results.items():
+        name = '%s/%s' % (prefix, key) if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and (key == 'mean_ms' or key.endswith('_per_sec')
+                                                 or key.endswith('_per_iteration')):
+            flat[name] = value
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmarks.run result files")
+    parser.add_argument("baseline", type=str)
+    parser.add_argument("candidate", type=str)
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help="relative change reported as faster / slower (default: 0.05)")
+    opts = parser.parse_args()
+
+    with open(opts.baseline) as f:
+        baseline = json.load(f)
+    with open(opts.candidate) as f:
+        candidate = json.load(f)
+    print("baseline:  %s" % baseline['environment'].get('commit'))
+    print("candidate: %s" % candidate['environment'].get('commit'))
+    base, cand = flatten({k: v for k, v in baseline.items() if k not in ('environment', 'options')}), \
+        flatten({k: v for k, v in candidate.items() if k not in ('environment', 'options')})
+    for name in sorted(set(base) & set(cand)):
+        if base[name] == 0 or cand[name] == 0:  # no ratio, e.g. a time below the timer resolution
+            continue
+        # times are better when lower, throughputs when higher
+        speedup = base[name] / cand[name] if not name.endswith('_per_sec') else cand[name] / base[name]
+        verdict = 'faster' if speedup > 1 + opts.threshold else 'slower' if speedup < 1 - opts.threshold else ''
+        print("%-70s %12.3f %12.3f %7.2fx %s" % (name, base[name], cand[name], speedup, verdict))
+
+
+if __name__ == '__main__':
+    main()
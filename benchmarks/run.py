@@ -0,0 +1,83 @@
+import argparse
+
+from . import bench_metrics, bench_models, bench_train_loop, bench_transforms
+from .common import environment, save_results
+
+
+SUITES = ['transforms', 'models', 'metrics', 'train_loop']
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description="Benchmarks on synthetic GTA5-sized data, run from the "
+                                                 "repository root: python -m benchmarks.run")
+    parser.add_argument("--suites", type=str, nargs='+', default=SUITES, choices=SUITES,
+                        help="benchmarks to run (default: all)")
+    parser.add_argument("--output", type=str, default='benchmark_results.json',
+                        help="JSON file of the results (default: benchmark_results.json)")
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="number of intra-op threads (default: torch default)")
+
+    # transforms
+    parser.add_argument("--transform_images", type=int, default=20,
+                        help="images per transform pipeline (default: 20)")
+    parser.add_argument("--crop_size", type=int, default=768)
+
+    # models
+    parser.add_argument("--models", type=str, nargs='+', default=None,
+                        help="model constructors to time (default: all of network.modeling)")
+    parser.add_argument("--output_strides", type=int, nargs='+', default=[8, 16])
+    parser.add_argument("--model_batch_size", type=int, default=2)
+    parser.add_argument("--model_input_size", type=int, nargs=2, default=[768, 768],
+                        help="height and width of the model inputs (default: 768 768)")
+    parser.add_argument("--model_runs", type=int, default=3,
+                        help="timed runs per model (default: 3)")
+    parser.add_argument("--memory_formats", type=str, nargs='+', default=['contiguous', 'channels_last'],
+                        choices=['contiguous', 'channels_last'],
+                        help="memory formats of the model weights and inputs (default: both)")
+
+    # metrics
+    parser.add_argument("--metrics_batch_size", type=int, default=4)
+
+    # train loop
+    parser.add_argument("--train_model", type=str, default='deeplabv3plus_mobilenet')
+    parser.add_argument("--train_output_stride", type=int, default=16)
+    parser.add_argument("--train_batch_size", type=int, default=2)
+    parser.add_argument("--train_iterations", type=int, default=5)
+    parser.add_argument("--train_num_workers", type=int, default=2)
+    parser.add_argument("--train_data_root", type=str, default=None,
+                        help="GTA dataset to load (default: synthetic images in a temporary directory)")
+    parser.add_argument("--train_args", type=str, default='',
+                        help="extra main.py options of the train loop, e.g. '--batch_transforms'")
+    return parser
+
+
+def main():
+    opts = get_argparser().parse_args()
+    if opts.num_threads is not None:
+        import torch
+        torch.set_num_threads(opts.num_threads)
+
+    results = {'environment': environment(), 'options': vars(opts)}
+    if 'transforms' in opts.suites:
+        results['transforms'] = bench_transforms.run(num_images=opts.transform_images, crop_size=opts.crop_size)
+    if 'models' in opts.suites:
+        results['models'] = bench_models.run(models=opts.models, output_strides=opts.output_strides,
+                                             batch_size=opts.model_batch_size,
+                                             input_size=opts.model_input_size, runs=opts.model_runs,
+                                             memory_formats=opts.memory_formats)
+    if 'metrics' in opts.suites:
+        results['metrics'] = bench_metrics.run(batch_size=opts.metrics_batch_size,
+                                               size=(opts.crop_size, opts.crop_size))
+    if 'train_loop' in opts.suites:
+        results['train_loop'] = bench_train_loop.run(model_name=opts.train_model,
+                                                     output_stride=opts.train_output_stride,
+                                                     batch_size=opts.train_batch_size,
+                                                     iterations=opts.train_iterations,
+                                                     num_workers=opts.train_num_workers,
+                                                     data_root=opts.train_data_root,
+                                                     extra_args=opts.train_args.split())
+    save_results(results, opts.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import argparse
+import os
+
+from datasets import Cityscapes, GTA, GTAV, build_label_cache
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description="Pre-encode labels to train ids in a memory-mapped uint8 file")
+    parser.add_argument("--data_root", type=str, required=True,
+                        help="path to Dataset")
+    parser.add_argument("--dataset", type=str, default='gta',
+                        choices=['gta', 'cityscapes', 'gtav'], help='Name of dataset')
+    parser.add_argument("--split", type=str, default='all',
+                        help="split to encode (default: all)")
+    parser.add_argument("--out_dir", type=str, required=True,
+                        help="output directory, the cache is written to <out_dir>/<dataset>_<split>.labels")
+    return parser
+
+
+def main():
+    opts = get_argparser().parse_args()
+    if opts.dataset == 'gta':
+        dst = GTA(root=opts.data_root, split=opts.split)
+    elif opts.dataset == 'cityscapes':
+        dst = Cityscapes(root=opts.data_root, split=opts.split)
+    else:
+        dst = GTAV(root=opts.data_root, split=opts.split)
+
+    os.makedirs(opts.out_dir, exist_ok=True)
+    path = os.path.join(opts.out_dir, '%s_%s.labels' % (opts.dataset, opts.split))
+    build_label_cache(dst.targets, dst.encode_target, path)
+    print("Cached %d labels at %s" % (len(dst.targets), path))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,11 @@
 from .voc import VOCSegmentation
 from .cityscapes import Cityscapes
 from .gta import GTA
-from .gtav import GTAV
\ No newline at end of file
+from .gtav import GTAV
+from .shards import ShardedSegmentationDataset, pack_shards
+from .label_cache import LabelCache, build_label_cache
+from .resize_cache import ResizeCache
+from .manifest import build_manifest, load_or_build_manifest
+from .class_index import RareClassSampler, build_class_index, load_or_build_class_index
+from .image_files import ImageFiles, SizeGroupedBatchSampler, read_image_sizes
+from .palette import Palette
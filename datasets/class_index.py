@@ -0,0 +1,130 @@
+import os
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.utils.data as data
+from PIL import Image
+from tqdm import tqdm
+
+
+def _train_id_lut(dataset_cls):
+    """ uint8 lookup table mapping raw label ids (0..255) to train ids """
+    lut = np.full(256, 255, dtype=np.uint8)
+    ids = dataset_cls.id_to_train_id
+    lut[:len(ids) - 1] = ids[:-1]  # the last entry is the 'license plate' class with id -1
+    return lut
+
+
+def build_class_index(dataset, num_classes=19):
+    """Count the pixels of every train id in every label of ``dataset``.
+
+    The counts come from the manifest histograms if the dataset has them, otherwise from
+    its label cache, and only as a last resort from decoding the label PNGs. Each label is
+    reduced with a single ``np.bincount``.
+
+    Returns:
+        numpy.ndarray: (N, num_classes) int64 array of pixel counts.
+    """
+    lut = _train_id_lut(type(dataset))
+    counts = np.zeros((len(dataset.targets), num_classes), dtype=np.int64)
+    manifest = getattr(dataset, 'manifest', None)
+    label_cache = getattr(dataset, 'label_cache', None)
+    for i in tqdm(range(len(dataset.targets))):
+        if manifest is not None and 'hist' in manifest['samples'][i]:
+            hist = np.asarray(manifest['samples'][i]['hist'], dtype=np.int64)
+            train_hist = np.bincount(lut[:len(hist)], weights=hist, minlength=256)
+        elif label_cache is not None:
+            train_hist = np.bincount(label_cache[i].ravel(), minlength=256)
+        else:
+            lbl = np.asarray(Image.open(dataset.targets[i]))
+            train_hist = np.bincount(lut[lbl].ravel(), minlength=256)
+        counts[i] = train_hist[:num_classes]
+    return counts
+
+
+def load_or_build_class_index(path, dataset, num_classes=19, build=True, timeout=3600):
+    """Load the class index stored at ``path``, building it first if needed.
+
+    As for the manifests, only the process that creates ``path + '.lock'`` builds the
+    index and writes it with an atomic rename; the others wait for it to appear. With
+    ``build=False`` (every rank but the first under torchrun) the process only waits.
+    """
+    lock = path + '.lock'
+    deadline = time.time() + timeout
+    while not os.path.isfile(path):
+        if time.time() > deadline:
+            raise RuntimeError('Timed out waiting for %s, remove %s if no other process is '
+                               'building it' % (path, lock))
+        if not build:
+            time.sleep(1)
+            continue
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            time.sleep(1)
+            continue
+        os.close(fd)
+        try:
+            if not os.path.isfile(path):
+                counts = build_class_index(dataset, num_classes)
+                tmp = '%s.%d.tmp' % (path, os.getpid())
+                with open(tmp, 'wb') as f:
+                    np.save(f, counts)
+                os.replace(tmp, path)
+        finally:
+            os.remove(lock)
+
+    counts = np.load(path)
+    if counts.shape != (len(dataset), num_classes):
+        raise RuntimeError('Class index %s does not match the dataset, please delete it' % path)
+    return counts
+
+
+class RareClassSampler(data.Sampler):
+    """Samples images with replacement, favouring the ones that contain rare classes.
+
+    The weight of image ``i`` is ``1 + boost * (number of rare classes with at least
+    min_pixels pixels in i)``, so an image with a rider and a motorcycle is drawn
+    ``1 + 2 * boost`` times as often as one with neither.
+
+    Args:
+        class_counts (numpy.ndarray): (N, C) pixel counts from ``build_class_index``.
+        rare_classes (list): train ids to oversample.
+        boost (float): extra weight per rare class present.
+        min_pixels (int): pixels a class needs to count as present.
+        num_samples (int, optional): samples per epoch, defaults to N.
+        seed (int): base seed, combined with the epoch set by ``set_epoch``.
+        num_replicas (int, optional): number of training processes, defaults to the
+            torch.distributed world size. All processes draw the same sequence and each
+            keeps every ``num_replicas``-th sample of it.
+        rank (int, optional): rank of this process, defaults to the torch.distributed rank.
+    """
+    def __init__(self, class_counts, rare_classes, boost=2.0, min_pixels=1, num_samples=None, seed=0,
+                 num_replicas=None, rank=None):
+        present = np.asarray(class_counts)[:, rare_classes] >= min_pixels
+        self.weights = torch.as_tensor(1.0 + boost * present.sum(axis=1), dtype=torch.double)
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        num_samples = len(self.weights) if num_samples is None else num_samples
+        self.num_samples = -(-num_samples // num_replicas)  # per process
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        total = self.num_samples * self.num_replicas
+        indices = torch.multinomial(self.weights, total, replacement=True, generator=g)
+        return iter(indices[self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
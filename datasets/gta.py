@@ -4,9 +4,13 @@ from collections import namedtuple
 
 import torch
 import torch.utils.data as data
-from PIL import Image
 import numpy as np
 
+from .label_cache import LabelCache
+from .palette import Palette
+from .utils import load_pair
+from .manifest import check_pairs, load_or_build_manifest
+
 
 class GTA(data.Dataset):
     """Cityscapes <http://www.cityscapes-dataset.com/> Dataset.
@@ -17,6 +21,9 @@ class GTA(data.Dataset):
         - **mode** (string, optional): The quality mode to use, 'gtFine' or 'gtCoarse' or 'color'. Can also be a list to output a tuple with all specified target types.
         - **transform** (callable, optional): A function/transform that takes in a PIL image and returns a transformed version. E.g, ``transforms.RandomCrop``
         - **target_transform** (callable, optional): A function/transform that takes in the target and transforms it.
+        - **label_cache** (string or LabelCache, optional): Labels pre-encoded to train ids by ``build_label_cache``. When given, targets are read from the memory-mapped cache and ``encode_target`` is skipped.
+        - **resize_cache** (ResizeCache, optional): Serves images and labels already resized by ``resize_cache.resize``, which must then be left out of ``transform``.
+        - **manifest** (string, optional): Path of a manifest file (paths, sizes, image dimensions, label histograms). It is built on first use and replaces the directory scan afterwards.
     """
 
     # Based on https://github.com/mcordts/cityscapesScripts
@@ -62,7 +69,9 @@ class GTA(data.Dataset):
 
     train_id_to_color = [c.color for c in classes if (c.train_id != -1 and c.train_id != 255)]
     train_id_to_color.append([0, 0, 0])
-    train_id_to_color = np.array(train_id_to_color)
+    train_id_to_color = np.array(train_id_to_color, dtype=np.uint8)
+    # train ids 19 to 255 (ignore index) are black
+    palette = Palette(train_id_to_color[:-1])
     id_to_train_id = np.array([c.train_id for c in classes])
     
     #train_id_to_color = [(0, 0, 0), (128, 64, 128), (70, 70, 70), (153, 153, 153), (107, 142, 35),
@@ -70,55 +79,52 @@ class GTA(data.Dataset):
     #train_id_to_color = np.array(train_id_to_color)
     #id_to_train_id = np.array([c.category_id for c in classes], dtype='uint8') - 1
 
-    def __init__(self, root, split='train', mode='fine', target_type='semantic', transform=None,train_rgb_lb_transform=None):
+    def __init__(self, root, split='train', mode='fine', target_type='semantic', transform=None,train_rgb_lb_transform=None, label_cache=None, resize_cache=None, manifest=None):
         self.root = os.path.expanduser(root)
         self.mode = 'LabelIds'
         self.target_type = target_type
-        self.images = []
-        self.targets = []
         self.target_rgb = []
         self.transform = transform
         self.train_rgb_lb_transform = train_rgb_lb_transform
 
-        if split != 'all' : 
-            self.images_dir = os.path.join(self.root, 'ColorIds', split)
-            self.targets_dir = os.path.join(self.root, self.mode, split)
-           
-            self.split = split
-            if not os.path.isdir(self.images_dir) or not os.path.isdir(self.targets_dir):
-                raise RuntimeError('Dataset not found or incomplete. Please make sure all required folders for the'
-                                ' specified "split" and "mode" are inside the "root" directory')
-            
-            for file_name in sorted(os.listdir(self.images_dir)):
-                self.images.append(os.path.join(self.images_dir, file_name))
-            
-            for file_name in sorted(os.listdir(self.targets_dir)):
-                self.targets.append(os.path.join(self.targets_dir, file_name))
-        
-        
+        self.split = split
+        if manifest is not None:
+            self.manifest = load_or_build_manifest(manifest, self.root, lambda: self._list_files(split))
+            self.images = [os.path.join(self.root, s['image']) for s in self.manifest['samples']]
+            self.targets = [os.path.join(self.root, s['target']) for s in self.manifest['samples']]
         else:
-            splits = ['train', 'val', 'test']
-            for split in splits : 
-                self.images_dir = os.path.join(self.root, 'ColorIds', split)
-                self.targets_dir = os.path.join(self.root, self.mode, split)
-                # self.target_dir_rgb = os.path.join(self.root,'ColorIds',split)
-                # print('target',self.targets_dir)
-                # print('target rgb',self.target_dir_rgb)
-                self.split = split
-                if not os.path.isdir(self.images_dir) or not os.path.isdir(self.targets_dir):
-                    raise RuntimeError('Dataset not found or incomplete. Please make sure all required folders for the'
-                                    ' specified "split" and "mode" are inside the "root" directory')
-                
-                for file_name in sorted(os.listdir(self.images_dir)):
-                    self.images.append(os.path.join(self.images_dir, file_name))
-                
-                for file_name in sorted(os.listdir(self.targets_dir)):
-                    self.targets.append(os.path.join(self.targets_dir, file_name))
-                # for file_name in sorted(os.listdir(self.target_dir_rgb)):
-                #     self.target_rgb.append(os.path.join(self.target_dir_rgb, file_name))
+            self.manifest = None
+            self.images, self.targets = self._list_files(split)
+
+        if isinstance(label_cache, str):
+            label_cache = LabelCache(label_cache)
+        if label_cache is not None:
+            label_cache.check(self.targets)
+        self.label_cache = label_cache
+        self.resize_cache = resize_cache
+
+
+
+
+    def _list_files(self, split):
+        """ scan the split directories, pairing images and targets by file stem """
+        images = []
+        targets = []
+        for split in (['train', 'val', 'test'] if split == 'all' else [split]):
+            images_dir = os.path.join(self.root, 'ColorIds', split)
+            targets_dir = os.path.join(self.root, self.mode, split)
+            if not os.path.isdir(images_dir) or not os.path.isdir(targets_dir):
+                raise RuntimeError('Dataset not found or incomplete. Please make sure all required folders for the'
+                                   ' specified "split" and "mode" are inside the "root" directory')
 
+            for file_name in sorted(os.listdir(images_dir)):
+                images.append(os.path.join(images_dir, file_name))
 
+            for file_name in sorted(os.listdir(targets_dir)):
+                targets.append(os.path.join(targets_dir, file_name))
 
+        check_pairs(images, targets)
+        return images, targets
 
     @classmethod
     def encode_target(cls, target):
@@ -126,9 +132,8 @@ class GTA(data.Dataset):
 
     @classmethod
     def decode_target(cls, target):
-        target[target == 255] = 19
-        #target = target.astype('uint8') + 1
-        return cls.train_id_to_color[target]
+        """ (..., H, W) train ids to uint8 (..., H, W, 3) colors, ``target`` is not modified """
+        return cls.palette.colorize(target)
 
     def __getitem__(self, index):
         """
@@ -138,8 +143,9 @@ class GTA(data.Dataset):
             tuple: (image, target) where target is a tuple of all target types if target_type is a list with more
             than one item. Otherwise target is a json object if target_type="polygon", else the image segmentation.
         """
-        image = Image.open(self.images[index]).convert('RGB')
-        target = Image.open(self.targets[index])
+        cached_label = self.label_cache[index] if self.label_cache is not None else None
+        image, target = load_pair(self.images[index], self.targets[index],
+                                  cached_label=cached_label, resize_cache=self.resize_cache)
         
         # rgb_labels = Image.open(self.target_rgb[index]).convert('RGB')
         
@@ -147,7 +153,8 @@ class GTA(data.Dataset):
         if self.transform:
             # image, target,rgb_labels = self.transform(image, target,rgb_labels)
             image, target = self.transform(image, target)
-        target = self.encode_target(target)
+        if self.label_cache is None:
+            target = self.encode_target(target)
 
         # rgb_lb = self.decode_target(target2)
 
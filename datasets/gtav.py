@@ -4,9 +4,13 @@ from collections import namedtuple
 
 import torch
 import torch.utils.data as data
-from PIL import Image
 import numpy as np
 
+from .label_cache import LabelCache
+from .palette import Palette
+from .utils import load_pair
+from .manifest import check_pairs, load_or_build_manifest
+
 
 class GTAV(data.Dataset):
     """Cityscapes <http://www.cityscapes-dataset.com/> Dataset.
@@ -17,6 +21,9 @@ class GTAV(data.Dataset):
         - **mode** (string, optional): The quality mode to use, 'gtFine' or 'gtCoarse' or 'color'. Can also be a list to output a tuple with all specified target types.
         - **transform** (callable, optional): A function/transform that takes in a PIL image and returns a transformed version. E.g, ``transforms.RandomCrop``
         - **target_transform** (callable, optional): A function/transform that takes in the target and transforms it.
+        - **label_cache** (string or LabelCache, optional): Labels pre-encoded to train ids by ``build_label_cache``. When given, targets are read from the memory-mapped cache and ``encode_target`` is skipped.
+        - **resize_cache** (ResizeCache, optional): Serves images and labels already resized by ``resize_cache.resize``, which must then be left out of ``transform``.
+        - **manifest** (string, optional): Path of a manifest file (paths, sizes, image dimensions, label histograms). It is built on first use and replaces the directory scan afterwards.
     """
 
     # Based on https://github.com/mcordts/cityscapesScripts
@@ -62,7 +69,9 @@ class GTAV(data.Dataset):
 
     train_id_to_color = [c.color for c in classes if (c.train_id != -1 and c.train_id != 255)]
     train_id_to_color.append([0, 0, 0])
-    train_id_to_color = np.array(train_id_to_color)
+    train_id_to_color = np.array(train_id_to_color, dtype=np.uint8)
+    # train ids 19 to 255 (ignore index) are black
+    palette = Palette(train_id_to_color[:-1])
     id_to_train_id = np.array([c.train_id for c in classes])
     
     #train_id_to_color = [(0, 0, 0), (128, 64, 128), (70, 70, 70), (153, 153, 153), (107, 142, 35),
@@ -70,7 +79,7 @@ class GTAV(data.Dataset):
     #train_id_to_color = np.array(train_id_to_color)
     #id_to_train_id = np.array([c.category_id for c in classes], dtype='uint8') - 1
 
-    def __init__(self, root, split='train', mode='fine', target_type='semantic', transform=None):
+    def __init__(self, root, split='train', mode='fine', target_type='semantic', transform=None, label_cache=None, resize_cache=None, manifest=None):
         self.root = os.path.expanduser(root)
         self.mode = 'gtFine'
         self.target_type = target_type
@@ -91,15 +100,36 @@ class GTAV(data.Dataset):
             raise RuntimeError('Dataset not found or incomplete. Please make sure all required folders for the'
                                ' specified "split" and "mode" are inside the "root" directory')
         
+        if manifest is not None:
+            self.manifest = load_or_build_manifest(manifest, self.root, self._list_files)
+            self.images = [os.path.join(self.root, s['image']) for s in self.manifest['samples']]
+            self.targets = [os.path.join(self.root, s['target']) for s in self.manifest['samples']]
+        else:
+            self.manifest = None
+            self.images, self.targets = self._list_files()
+
+        if isinstance(label_cache, str):
+            label_cache = LabelCache(label_cache)
+        if label_cache is not None:
+            label_cache.check(self.targets)
+        self.label_cache = label_cache
+        self.resize_cache = resize_cache
+
+    def _list_files(self):
+        """ scan the city directories, pairing images and targets by file stem """
+        images = []
+        targets = []
         for city in os.listdir(self.images_dir):
             img_dir = os.path.join(self.images_dir, city)
             target_dir = os.path.join(self.targets_dir, city)
 
             for file_name in os.listdir(img_dir):
-                self.images.append(os.path.join(img_dir, file_name))
+                images.append(os.path.join(img_dir, file_name))
                 # target_name = '{}_{}'.format(file_name.split('_leftImg8bit')[0],
                 #                              self._get_target_suffix(self.mode, self.target_type))
-                self.targets.append(os.path.join(target_dir, file_name))
+                targets.append(os.path.join(target_dir, file_name))
+        check_pairs(images, targets)
+        return images, targets
 
     @classmethod
     def encode_target(cls, target):
@@ -107,9 +137,8 @@ class GTAV(data.Dataset):
 
     @classmethod
     def decode_target(cls, target):
-        target[target == 255] = 19
-        #target = target.astype('uint8') + 1
-        return cls.train_id_to_color[target]
+        """ (..., H, W) train ids to uint8 (..., H, W, 3) colors, ``target`` is not modified """
+        return cls.palette.colorize(target)
 
     def __getitem__(self, index):
         """
@@ -119,11 +148,13 @@ class GTAV(data.Dataset):
             tuple: (image, target) where target is a tuple of all target types if target_type is a list with more
             than one item. Otherwise target is a json object if target_type="polygon", else the image segmentation.
         """
-        image = Image.open(self.images[index]).convert('RGB')
-        target = Image.open(self.targets[index])
+        cached_label = self.label_cache[index] if self.label_cache is not None else None
+        image, target = load_pair(self.images[index], self.targets[index],
+                                  cached_label=cached_label, resize_cache=self.resize_cache)
         if self.transform:
             image, target = self.transform(image, target)
-        target = self.encode_target(target)
+        if self.label_cache is None:
+            target = self.encode_target(target)
         return image, target
 
     def __len__(self):
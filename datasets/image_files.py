@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch.utils.data as data
+from PIL import Image
+
+
+def read_image_sizes(files, num_workers=8):
+    """ (w, h) of every image, read from the file headers only """
+    def size(path):
+        with Image.open(path) as img:
+            return img.size
+    with ThreadPoolExecutor(num_workers) as pool:
+        return list(pool.map(size, files))
+
+
+class ImageFiles(data.Dataset):
+    """Unlabeled images for inference.
+
+    **Parameters:**
+        - **files** (list): Image paths.
+        - **transform** (callable, optional): A function/transform that takes in a PIL image and returns a transformed version.
+
+    Items are ``(image, index)`` so that predictions can be matched with ``files``.
+    """
+    def __init__(self, files, transform=None):
+        self.files = files
+        self.transform = transform
+
+    def __getitem__(self, index):
+        img = Image.open(self.files[index]).convert('RGB')
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, index
+
+    def __len__(self):
+        return len(self.files)
+
+
+class SizeGroupedBatchSampler(data.Sampler):
+    """Batches of indices whose images have the same size, so that they can be
+    collated without padding. Groups keep the order of first appearance.
+
+    Args:
+        sizes (list): size of every image, e.g. from ``read_image_sizes``.
+        batch_size (int): maximum number of images per batch.
+    """
+    def __init__(self, sizes, batch_size):
+        groups = OrderedDict()
+        for index, size in enumerate(sizes):
+            groups.setdefault(size, []).append(index)
+        self.batches = []
+        for indices in groups.values():
+            for i in range(0, len(indices), batch_size):
+                self.batches.append(indices[i:i + batch_size])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
@@ -0,0 +1,76 @@
+import json
+import os
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+def build_label_cache(targets, encode_target, path):
+    """Encode every label map to train ids once and store them as one uint8 array file.
+
+    The labels are written back to back into ``path`` (one contiguous C-order block of
+    ``H*W`` bytes per sample) and ``path + '.json'`` records the byte offset and shape of
+    each block, together with the source file list.
+
+    Args:
+        targets (list): paths of the raw label maps.
+        encode_target (callable): maps a raw label image to train ids, e.g. ``GTA.encode_target``.
+        path (str): output file.
+    """
+    offsets = []
+    shapes = []
+    offset = 0
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for target in tqdm(targets):
+            lbl = encode_target(Image.open(target))
+            if lbl.min() < 0 or lbl.max() > 255:
+                raise ValueError('train ids of %s do not fit in uint8' % target)
+            lbl = np.ascontiguousarray(lbl, dtype=np.uint8)
+            f.write(lbl.tobytes())
+            offsets.append(offset)
+            shapes.append(list(lbl.shape))
+            offset += lbl.nbytes
+    os.replace(tmp_path, path)
+    with open(path + '.json', 'w') as fp:
+        json.dump({'targets': list(targets), 'offsets': offsets, 'shapes': shapes}, fp)
+
+
+class LabelCache(object):
+    """Read-only view of a file written by ``build_label_cache``.
+
+    The array file is memory-mapped lazily, so that every DataLoader worker maps it
+    on first access instead of pickling the data. ``cache[i]`` is a zero-copy (H, W)
+    uint8 view into the mapping, ``load_pair`` copies it into a PIL image for the
+    transforms.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.json', 'r') as fp:
+            index = json.load(fp)
+        self.targets = index['targets']
+        self.offsets = index['offsets']
+        self.shapes = [tuple(s) for s in index['shapes']]
+        self._data = None
+
+    def check(self, targets):
+        # compare basenames so that the cache survives moving the dataset root
+        if [os.path.basename(t) for t in targets] != [os.path.basename(t) for t in self.targets]:
+            raise RuntimeError('Label cache %s was built for a different list of targets, '
+                               'please rebuild it' % self.path)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        h, w = self.shapes[index]
+        offset = self.offsets[index]
+        return self._data[offset:offset + h * w].reshape(h, w)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
@@ -0,0 +1,104 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+MANIFEST_VERSION = 2
+
+
+def _stem(path, sep=None):
+    name = os.path.splitext(os.path.basename(path))[0]
+    if sep is not None:
+        name = name.split(sep)[0]
+    return name
+
+
+def check_pairs(images, targets, image_sep=None, target_sep=None):
+    """Make sure that ``images[i]`` and ``targets[i]`` belong to the same sample.
+
+    Stems are the basenames without extension, cut at ``image_sep`` / ``target_sep``
+    if given (e.g. ``'_leftImg8bit'`` and ``'_gtFine'`` for Cityscapes).
+    """
+    if len(images) != len(targets):
+        raise RuntimeError('Found %d images but %d targets' % (len(images), len(targets)))
+    for img, lbl in zip(images, targets):
+        if _stem(img, image_sep) != _stem(lbl, target_sep):
+            raise RuntimeError('Image %s and target %s do not match' % (img, lbl))
+
+
+def _describe(root, img_path, lbl_path, with_histogram):
+    with Image.open(img_path) as img:  # only reads the header
+        width, height = img.size
+    entry = {
+        'image': os.path.relpath(img_path, root),
+        'target': os.path.relpath(lbl_path, root),
+        'image_bytes': os.path.getsize(img_path),
+        'target_bytes': os.path.getsize(lbl_path),
+        'width': width,
+        'height': height,
+    }
+    if with_histogram:
+        lbl = np.asarray(Image.open(lbl_path))
+        entry['hist'] = np.bincount(lbl.ravel()).tolist()
+    return entry
+
+
+def build_manifest(root, images, targets, with_histogram=True, num_workers=8):
+    """Describe every (image, target) pair of a dataset.
+
+    Returns:
+        dict: ``{'version', 'root', 'samples'}`` where each sample holds the paths relative to
+        ``root``, the file sizes, the image size and, if ``with_histogram``, the pixel
+        count of every raw label id.
+    """
+    with ThreadPoolExecutor(num_workers) as pool:
+        samples = list(tqdm(pool.map(lambda p: _describe(root, p[0], p[1], with_histogram),
+                                     zip(images, targets)), total=len(images)))
+    return {'version': MANIFEST_VERSION, 'root': os.path.abspath(root), 'samples': samples}
+
+
+def load_or_build_manifest(path, root, list_files, with_histogram=True, timeout=3600):
+    """Load the manifest at ``path``, building it with ``list_files()`` the first time.
+
+    ``list_files`` returns the (images, targets) lists of a fresh directory scan. When
+    several processes start at once, only the one that creates ``path + '.lock'`` scans
+    the dataset; the others wait for the manifest to appear instead of walking the same
+    directories. A manifest built for another ``root`` is rejected, its relative paths
+    and histograms would describe other files.
+    """
+    lock = path + '.lock'
+    deadline = time.time() + timeout
+    while not os.path.isfile(path):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if time.time() > deadline:
+                raise RuntimeError('Timed out waiting for %s, remove %s if no other process is '
+                                   'building it' % (path, lock))
+            time.sleep(1)
+            continue
+        os.close(fd)
+        try:
+            if not os.path.isfile(path):
+                images, targets = list_files()
+                manifest = build_manifest(root, images, targets, with_histogram=with_histogram)
+                tmp = '%s.%d.tmp' % (path, os.getpid())
+                with open(tmp, 'w') as fp:
+                    json.dump(manifest, fp)
+                os.replace(tmp, path)
+        finally:
+            os.remove(lock)
+
+    with open(path, 'r') as fp:
+        manifest = json.load(fp)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise RuntimeError('Manifest %s has an unsupported version, please delete it' % path)
+    if manifest['root'] != os.path.abspath(root):
+        raise RuntimeError('Manifest %s was built for %s, not %s. Please use another manifest directory '
+                           'or delete it' % (path, manifest['root'], os.path.abspath(root)))
+    return manifest
@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+from PIL import Image
+
+
+def _to_label_range(target):
+    """ labels outside 0-255 replaced by the ignore index 255, without copying uint8 maps """
+    target = np.asarray(target)
+    if target.dtype == np.uint8:
+        return target
+    return np.where((target < 0) | (target > 255), 255, target)
+
+
+class Palette(object):
+    """Colors of label maps, stored as a 256-entry uint8 lookup table.
+
+    **Parameters:**
+        - **colors** (array-like): (N, 3) RGB color of the labels 0 to N-1, N <= 256.
+        - **fill** (tuple): color of the labels N to 255, which include the ignore index 255.
+
+    ``colorize`` accepts numpy arrays or tensors of any integer type and shape, e.g. a
+    (H, W) label map or a (B, H, W) batch, returns uint8 colors with a trailing axis of
+    size 3 and never modifies its input. Tensors are colorized on their device. Labels
+    outside 0-255, negative ones included, are treated as the ignore index 255.
+    """
+    def __init__(self, colors, fill=(0, 0, 0)):
+        colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+        if len(colors) > 256:
+            raise ValueError('a palette holds at most 256 colors, got %d' % len(colors))
+        self.lut = np.empty((256, 3), dtype=np.uint8)
+        self.lut[:] = fill
+        self.lut[:len(colors)] = colors
+        self._torch_luts = {}
+
+    def colorize(self, target):
+        if torch.is_tensor(target):
+            return self.colorize_tensor(target)
+        return np.take(self.lut, _to_label_range(target), axis=0)
+
+    __call__ = colorize
+
+    def colorize_tensor(self, target):
+        lut = self._torch_luts.get(target.device)
+        if lut is None:
+            lut = self._torch_luts[target.device] = torch.from_numpy(self.lut).to(target.device)
+        target = target.long()
+        return lut[target.masked_fill((target < 0) | (target > 255), 255)]
+
+    def to_image(self, target):
+        """ palettized ("P" mode) PIL image of a (H, W) label map, a third of the size of an RGB one """
+        if torch.is_tensor(target):
+            target = target.cpu().numpy()
+        image = Image.fromarray(_to_label_range(target).astype(np.uint8, copy=False))
+        image.putpalette(self.lut.tobytes())  # turns the "L" image into a "P" one
+        return image
+
+    def __getstate__(self):
+        return {'lut': self.lut}
+
+    def __setstate__(self, state):
+        self.lut = state['lut']
+        self._torch_luts = {}
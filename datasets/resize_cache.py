@@ -0,0 +1,72 @@
+import hashlib
+import os
+
+import numpy as np
+from PIL import Image
+
+
+class ResizeCache(object):
+    """Persistent on-disk cache of decoded and resized images and labels.
+
+    Entries are keyed by (absolute file path, mtime, size, resize spec) and stored as
+    raw ``.npy`` arrays, which load with a plain read (or a memory map) instead of a
+    PNG decode plus resample. They are created lazily on first access and published
+    with an atomic rename, so concurrent DataLoader workers and processes can share
+    one cache directory; a race only means an entry is computed twice.
+
+    Args:
+        cache_dir (str): directory holding the cache entries.
+        resize (ExtResize): the deterministic resize whose output is cached. Images use
+            its interpolation, labels always use nearest neighbour.
+    """
+    def __init__(self, cache_dir, resize):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.resize = resize
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry(self, path, interpolation):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = '%s|%d|%d|%s|%s' % (path, st.st_mtime_ns, st.st_size, self.resize.size, interpolation)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def _cached(self, path, mode, interpolation):
+        entry = self._entry(path, interpolation)
+        if os.path.isfile(entry):
+            try:
+                return Image.fromarray(np.load(entry, mmap_mode='r'))
+            except (OSError, ValueError):
+                pass  # truncated or corrupted entry, rebuild it below
+        img = Image.open(path)
+        if mode is not None:
+            img = img.convert(mode)
+        img = img.resize(self._size(img), interpolation)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = '%s.%d.tmp' % (entry, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(img))
+        os.replace(tmp, entry)
+        return img
+
+    def _size(self, img):
+        """ PIL (w, h) of the output, same semantics as torchvision's resize """
+        size = self.resize.size
+        if isinstance(size, int):
+            w, h = img.size
+            if w <= h:
+                return size, int(size * h / w)
+            return int(size * w / h), size
+        return size[1], size[0]
+
+    def image(self, path):
+        """ resized RGB image, from the cache if possible """
+        return self._cached(path, 'RGB', self.resize.interpolation)
+
+    def target(self, path):
+        """ resized raw label, from the cache if possible """
+        return self._cached(path, None, Image.NEAREST)
+
+    def resize_target(self, target):
+        """ resize an already decoded label, e.g. one served by a LabelCache """
+        return target.resize(self._size(target), Image.NEAREST)
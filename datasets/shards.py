@@ -0,0 +1,206 @@
+import io
+import json
+import os
+import random
+
+import torch.distributed as dist
+import torch.utils.data as data
+from PIL import Image
+from tqdm import tqdm
+
+
+INDEX_NAME = 'index.json'
+
+
+def pack_shards(images, targets, out_dir, shard_size=1 << 30, names=None):
+    """Pack (image, target) file pairs into a few large shard files.
+
+    The encoded bytes of every file are copied verbatim (no re-encoding), so
+    decoding stays identical to reading the original PNGs. Each sample is
+    stored as ``image bytes | target bytes`` and samples are appended to the
+    current shard until it grows beyond ``shard_size`` bytes.
+
+    Args:
+        images (list): paths of the input images.
+        targets (list): paths of the label maps, paired by position with ``images``.
+        out_dir (str): output directory for the shards and ``index.json``.
+        shard_size (int): soft limit of a shard in bytes.
+        names (list, optional): sample names stored in the index. Defaults to the image basenames.
+    Returns:
+        dict: the index that was written to ``out_dir/index.json``.
+    """
+    if len(images) != len(targets):
+        raise ValueError('images and targets must have the same length, got %d and %d'
+                         % (len(images), len(targets)))
+    if names is None:
+        names = [os.path.basename(p) for p in images]
+    os.makedirs(out_dir, exist_ok=True)
+
+    shards = []
+    samples = []
+    f = None
+    offset = 0
+    for img_path, lbl_path, name in tqdm(zip(images, targets, names), total=len(images)):
+        if f is None or offset >= shard_size:
+            if f is not None:
+                f.close()
+            shards.append('shard-%05d.bin' % len(shards))
+            f = open(os.path.join(out_dir, shards[-1]), 'wb')
+            offset = 0
+        with open(img_path, 'rb') as src:
+            img_bytes = src.read()
+        with open(lbl_path, 'rb') as src:
+            lbl_bytes = src.read()
+        f.write(img_bytes)
+        f.write(lbl_bytes)
+        samples.append([len(shards) - 1, offset, len(img_bytes), len(lbl_bytes), name])
+        offset += len(img_bytes) + len(lbl_bytes)
+    if f is not None:
+        f.close()
+
+    index = {'shards': shards, 'samples': samples}
+    tmp_path = os.path.join(out_dir, INDEX_NAME + '.tmp')
+    with open(tmp_path, 'w') as fp:
+        json.dump(index, fp)
+    os.replace(tmp_path, os.path.join(out_dir, INDEX_NAME))
+    return index
+
+
+def _split_range(n, parts, part):
+    """ contiguous [start, end) slice of ``range(n)`` owned by ``part`` """
+    start = n * part // parts
+    end = n * (part + 1) // parts
+    return start, end
+
+
+class ShardedSegmentationDataset(data.IterableDataset):
+    """Iterable dataset reading (image, target) pairs from shards written by ``pack_shards``.
+
+    Every epoch the shard order is shuffled, then the resulting sample sequence is cut
+    into contiguous ranges, one per DataLoader worker, so that each worker reads its
+    shards front to back with sequential I/O. A small in-memory buffer shuffles samples
+    inside that stream.
+
+    **Parameters:**
+        - **root** (string): Directory containing ``index.json`` and the shard files.
+        - **decode_target** (callable): Colorizes train ids, e.g. ``GTA.decode_target``. The shards do not record the label set, so it has to be given.
+        - **transform** (callable, optional): A joint transform ``(image, target) -> (image, target)``, e.g. ``ExtCompose``.
+        - **encode_target** (callable, optional): Maps the transformed raw label to train ids, e.g. ``GTA.encode_target``.
+        - **shuffle** (bool, optional): Shuffle shard order and samples. Call ``set_epoch`` every epoch to reshuffle.
+        - **buffer_size** (int, optional): Number of encoded samples kept in the shuffle buffer.
+        - **seed** (int, optional): Base seed of the shuffling.
+        - **rank**, **num_replicas** (int, optional): Position of this process among the training processes. Default to the ``torch.distributed`` rank and world size when a process group is initialized. Every (process, worker) pair then reads its own contiguous range, and the sequence is truncated so that all processes see the same number of samples.
+    """
+
+    def __init__(self, root, decode_target, transform=None, encode_target=None,
+                 shuffle=True, buffer_size=32, seed=0, rank=None, num_replicas=None):
+        self.root = os.path.expanduser(root)
+        index_path = os.path.join(self.root, INDEX_NAME)
+        if not os.path.isfile(index_path):
+            raise RuntimeError('Shard index not found at %s. Please run pack_shards.py first' % index_path)
+        with open(index_path, 'r') as fp:
+            index = json.load(fp)
+        self.shards = [os.path.join(self.root, s) for s in index['shards']]
+        self.samples = index['samples']
+        self.transform = transform
+        self._encode_target = encode_target
+        self._decode_target = decode_target
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.rank = rank
+        self.num_replicas = num_replicas
+
+        self._by_shard = [[] for _ in self.shards]
+        for sample in self.samples:
+            self._by_shard[sample[0]].append(sample)
+        for samples in self._by_shard:
+            samples.sort(key=lambda s: s[1])
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def encode_target(self, target):
+        if self._encode_target is None:
+            return target
+        return self._encode_target(target)
+
+    def decode_target(self, target):
+        return self._decode_target(target)
+
+    def __len__(self):
+        return len(self.samples) // self.num_replicas
+
+    def _ordered_samples(self, rng):
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            rng.shuffle(order)
+        samples = []
+        for shard_id in order:
+            samples.extend(self._by_shard[shard_id])
+        return samples
+
+    def _read(self, samples):
+        f = None
+        cur_shard = None
+        try:
+            for shard_id, offset, img_len, lbl_len, _ in samples:
+                if shard_id != cur_shard:
+                    if f is not None:
+                        f.close()
+                    f = open(self.shards[shard_id], 'rb', buffering=8 << 20)
+                    cur_shard = shard_id
+                    f.seek(offset)
+                elif f.tell() != offset:
+                    f.seek(offset)
+                img_bytes = f.read(img_len)
+                lbl_bytes = f.read(lbl_len)
+                yield img_bytes, lbl_bytes
+        finally:
+            if f is not None:
+                f.close()
+
+    def _load(self, img_bytes, lbl_bytes):
+        image = Image.open(io.BytesIO(img_bytes)).convert('RGB')
+        target = Image.open(io.BytesIO(lbl_bytes))
+        if self.transform:
+            image, target = self.transform(image, target)
+        target = self.encode_target(target)
+        return image, target
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        samples = self._ordered_samples(rng)
+
+        worker_info = data.get_worker_info()
+        num_workers, worker_id = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        parts = self.num_replicas * num_workers
+        part = self.rank * num_workers + worker_id
+        if worker_info is not None or parts > 1:
+            if self.num_replicas > 1:
+                # equal ranges, so that no process runs out of batches before the others
+                samples = samples[:len(samples) - len(samples) % parts]
+            start, end = _split_range(len(samples), parts, part)
+            samples = samples[start:end]
+            rng = random.Random(self.seed + self.epoch * 1000 + part)
+
+        if not self.shuffle or self.buffer_size <= 1:
+            for img_bytes, lbl_bytes in self._read(samples):
+                yield self._load(img_bytes, lbl_bytes)
+            return
+
+        buffer = []
+        for img_bytes, lbl_bytes in self._read(samples):
+            buffer.append((img_bytes, lbl_bytes))
+            if len(buffer) >= self.buffer_size:
+                i = rng.randrange(len(buffer))
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                yield self._load(*buffer.pop())
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield self._load(*item)
@@ -123,4 +123,30 @@ def list_files(root, suffix, prefix=False):
     if prefix is True:
         files = [os.path.join(root, d) for d in files]
 
-    return files
\ No newline at end of file
+    return files
+
+def load_pair(img_path, lbl_path, cached_label=None, resize_cache=None):
+    """Load one (image, target) PIL pair, honoring the optional caches.
+    Args:
+        img_path (str): path of the image.
+        lbl_path (str): path of the raw label map.
+        cached_label (numpy.ndarray, optional): label already encoded to train ids, e.g. from a ``LabelCache``.
+            It saves the PNG decode, not the copy into the PIL target.
+        resize_cache (ResizeCache, optional): serves images and labels already resized.
+    """
+    from PIL import Image
+
+    if resize_cache is not None:
+        image = resize_cache.image(img_path)
+    else:
+        image = Image.open(img_path).convert('RGB')
+
+    if cached_label is not None:
+        target = Image.fromarray(cached_label)
+        if resize_cache is not None:
+            target = resize_cache.resize_target(target)
+    elif resize_cache is not None:
+        target = resize_cache.target(lbl_path)
+    else:
+        target = Image.open(lbl_path)
+    return image, target
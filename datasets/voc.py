@@ -8,6 +8,7 @@ import numpy as np
 
 from PIL import Image
 from torchvision.datasets.utils import download_url, check_integrity
+from .palette import Palette
 
 DATASET_YEAR_DICT = {
     '2012': {
@@ -82,6 +83,7 @@ class VOCSegmentation(data.Dataset):
             and returns a transformed version. E.g, ``transforms.RandomCrop``
     """
     cmap = voc_cmap()
+    palette = Palette(cmap)
     def __init__(self,
                  root,
                  year='2012',
@@ -154,8 +156,8 @@ class VOCSegmentation(data.Dataset):
 
     @classmethod
     def decode_target(cls, mask):
-        """decode semantic mask to RGB image"""
-        return cls.cmap[mask]
+        """decode semantic mask to uint8 RGB image"""
+        return cls.palette.colorize(mask)
 
 def download_extract(url, root, filename, md5):
     download_url(url, root, filename, md5)
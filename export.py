@@ -0,0 +1,163 @@
+import network
+import os
+import argparse
+from glob import glob
+
+import torch
+from torchvision import transforms as T
+from PIL import Image
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser()
+
+    # Deeplab Options
+    available_models = sorted(name for name in network.modeling.__dict__ if name.islower() and \
+                              not (name.startswith("__") or name.startswith('_')) and callable(
+                              network.modeling.__dict__[name])
+                              )
+    parser.add_argument("--model", type=str, default='deeplabv3plus_mobilenet',
+                        choices=available_models, help='model name')
+    parser.add_argument("--num_classes", type=int, default=19,
+                        help="num classes (default: 19)")
+    parser.add_argument("--separable_conv", action='store_true', default=False,
+                        help="apply separable conv to decoder and aspp")
+    parser.add_argument("--output_stride", type=int, default=16, choices=[8, 16])
+    parser.add_argument("--ckpt", default=None, type=str,
+                        help="checkpoint written by main.py")
+    parser.add_argument("--fuse_bn", action='store_true', default=False,
+                        help="fold BatchNorm layers into the preceding convolutions before exporting")
+
+    # Export Options
+    parser.add_argument("--format", type=str, default='both', choices=['torchscript', 'onnx', 'both'],
+                        help="exported graph format (default: both)")
+    parser.add_argument("--output_dir", type=str, default='exported',
+                        help="directory of the exported graphs (default: exported)")
+    parser.add_argument("--export_size", type=int, nargs=2, default=[512, 1024],
+                        help="height and width of the example input used for tracing (default: 512 1024)")
+    parser.add_argument("--opset", type=int, default=17,
+                        help="ONNX opset version (default: 17)")
+
+    # Parity check Options
+    parser.add_argument("--check_images", type=str, default=None,
+                        help="image or image directory used for the parity check (default: random inputs)")
+    parser.add_argument("--check_samples", type=int, default=4,
+                        help="number of inputs of the parity check (default: 4)")
+    parser.add_argument("--atol", type=float, default=1e-3,
+                        help="largest accepted logit difference, relative to the largest logit (default: 1e-3)")
+    return parser
+
+
+def load_model(opts):
+    """ eval model in inference mode (logits only), with the weights of a main.py checkpoint """
+    restore = opts.ckpt is not None and os.path.isfile(opts.ckpt)
+    # every weight comes from the checkpoint, the ImageNet backbone would only be downloaded and overwritten
+    model = network.modeling.__dict__[opts.model](num_classes=opts.num_classes, output_stride=opts.output_stride,
+                                                  pretrained_backbone=not restore)
+    if opts.separable_conv and 'plus' in opts.model:
+        network.convert_to_separable_conv(model.classifier)
+    if restore:
+        # main.py checkpoints hold numpy scalars (best_score), which weights_only loading rejects
+        checkpoint = torch.load(opts.ckpt, map_location=torch.device('cpu'), weights_only=False)
+        state_dict = checkpoint.get("model_state", checkpoint)
+        # checkpoints of a DataParallel / DistributedDataParallel model
+        state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+        model.load_state_dict(state_dict)
+        print("Model restored from %s" % opts.ckpt)
+        del checkpoint
+    else:
+        print("[!] No checkpoint, exporting random weights")
+    model.eval()
+    if opts.fuse_bn:
+        model = network.fuse_for_inference(model)
+    # returning the logits only avoids the feature dict of IntermediateLayerGetter in the graph
+    return model.set_inference(True)
+
+
+def get_check_inputs(opts):
+    """ normalized (1, 3, H, W) inputs, at sizes other than the export size to exercise dynamic shapes.
+    Random inputs stay multiples of 32 if the export size is, as HRNet requires.
+    """
+    if opts.check_images is None:
+        h, w = opts.export_size
+        sizes = [(h, w), (h + 64, w + 128), (w, h), (h + 32, w + 32)]
+        return [torch.randn(1, 3, *sizes[i % len(sizes)]) for i in range(opts.check_samples)]
+    if os.path.isdir(opts.check_images):
+        files = []
+        for ext in ['png', 'jpeg', 'jpg', 'JPEG']:
+            files.extend(glob(os.path.join(opts.check_images, '**/*.%s' % ext), recursive=True))
+    else:
+        files = [opts.check_images]
+    transform = T.Compose([
+        T.ToTensor(),
+        T.Normalize(mean=[0.485, 0.456, 0.406],
+                    std=[0.229, 0.224, 0.225]),
+    ])
+    return [transform(Image.open(f).convert('RGB')).unsqueeze(0) for f in sorted(files)[:opts.check_samples]]
+
+
+def check_parity(name, model, run, inputs, atol):
+    """ compare the logits of ``run(input)`` with the eager model, returns True if all match """
+    ok = True
+    with torch.no_grad():
+        for x in inputs:
+            expected = model(x)
+            actual = torch.as_tensor(run(x))
+            err = ((expected - actual).abs().max() / expected.abs().max().clamp(min=1e-6)).item()
+            agree = (expected.argmax(1) == actual.argmax(1)).float().mean().item()
+            ok = ok and err <= atol
+            print("[%s] input %s: max rel. error %.2e, argmax agreement %.4f %s" %
+                  (name, tuple(x.shape[2:]), err, agree, 'OK' if err <= atol else 'FAILED'))
+    return ok
+
+
+def main():
+    opts = get_argparser().parse_args()
+    os.makedirs(opts.output_dir, exist_ok=True)
+    model = load_model(opts)
+    example_input = torch.randn(1, 3, *opts.export_size)
+    inputs = get_check_inputs(opts)
+    ok = True
+
+    if opts.format in ('torchscript', 'both'):
+        path = os.path.join(opts.output_dir, '%s.pt' % opts.model)
+        with torch.no_grad():
+            # tracing unrolls the python control flow of IntermediateLayerGetter (hrnet_flag
+            # transitions included) while keeping the input height and width symbolic
+            traced = torch.jit.trace(model, example_input)
+        torch.jit.save(traced, path)
+        print("TorchScript model saved as %s" % path)
+        loaded = torch.jit.load(path)
+        ok = check_parity('torchscript', model, loaded, inputs, opts.atol) and ok
+
+    if opts.format in ('onnx', 'both'):
+        try:
+            import onnx
+        except ImportError:
+            if opts.format == 'onnx':
+                raise SystemExit("ONNX export needs the onnx package")
+            print("[!] onnx is not installed, skipping the ONNX export")
+            opts.format = 'torchscript'
+    if opts.format in ('onnx', 'both'):
+        path = os.path.join(opts.output_dir, '%s.onnx' % opts.model)
+        with torch.no_grad():
+            torch.onnx.export(model, (example_input,), path, dynamo=False, opset_version=opts.opset,
+                              input_names=['image'], output_names=['logits'],
+                              dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                            'logits': {0: 'batch', 2: 'height', 3: 'width'}})
+        print("ONNX model saved as %s" % path)
+        try:
+            import onnxruntime
+        except ImportError:
+            print("[!] onnxruntime is not installed, skipping the ONNX parity check")
+        else:
+            session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+            run = lambda x: session.run(['logits'], {'image': x.numpy()})[0]
+            ok = check_parity('onnx', model, run, inputs, opts.atol) and ok
+
+    if not ok:
+        raise SystemExit("Exported model does not match the eager model")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,13 @@ import utils
 import os
 import random
 import argparse
+import hashlib
 import numpy as np
+from contextlib import nullcontext
 
 from torch.utils import data
-from datasets import VOCSegmentation, Cityscapes, GTA, GTAV
+from datasets import VOCSegmentation, Cityscapes, GTA, GTAV, ShardedSegmentationDataset, ResizeCache, \
+    RareClassSampler, load_or_build_class_index
 from utils import ext_transforms as et
 from metrics import StreamSegMetrics
 import pandas as pd
@@ -15,9 +18,8 @@ import pandas as pd
 import torch
 import torch.nn as nn
 from utils.visualizer import Visualizer
+from utils.distributed import init_distributed, is_main_process, shard_dataset, get_rank, get_world_size
 
-from PIL import Image
-import matplotlib
 import matplotlib.pyplot as plt
 import cv2
 from tensorboardX import SummaryWriter
@@ -33,6 +35,26 @@ def get_argparser():
                         choices=['voc', 'cityscapes'], help='Name of dataset')
     parser.add_argument("--num_classes", type=int, default=None,
                         help="num classes (default: None)")
+    parser.add_argument("--shard_root", type=str, default=None,
+                        help="train from shards written by pack_shards.py instead of --data_root (default: None)")
+    parser.add_argument("--label_cache_dir", type=str, default=None,
+                        help="read labels from caches written by cache_labels.py (default: None)")
+    parser.add_argument("--manifest_dir", type=str, default=None,
+                        help="build dataset manifests here once and reuse them instead of scanning --data_root (default: None)")
+    parser.add_argument("--resize_cache_dir", type=str, default=None,
+                        help="cache decoded and resized images on disk, filled lazily on first access (default: None)")
+    parser.add_argument("--rare_class_sampling", action='store_true', default=False,
+                        help="oversample images with rare classes and center some crops on them")
+    parser.add_argument("--rare_classes", type=str, default='rider,train,motorcycle',
+                        help="comma separated class names or train ids to oversample (default: rider,train,motorcycle)")
+    parser.add_argument("--rare_class_boost", type=float, default=2.0,
+                        help="extra sampling weight per rare class present in an image (default: 2.0)")
+    parser.add_argument("--focus_crop_prob", type=float, default=0.5,
+                        help="probability of centering a training crop on a rare class pixel (default: 0.5)")
+    parser.add_argument("--class_index", type=str, default=None,
+                        help="per-image class pixel counts, built on first use "
+                             "(default: class_index_gta_all[_<root hash>].npy in --manifest_dir or --data_root, "
+                             "./checkpoints if that is read-only)")
 
     # Deeplab Options
     available_models = sorted(name for name in network.modeling.__dict__ if name.islower() and \
@@ -44,11 +66,16 @@ def get_argparser():
     parser.add_argument("--separable_conv", action='store_true', default=False,
                         help="apply separable conv to decoder and aspp")
     parser.add_argument("--output_stride", type=int, default=16, choices=[8, 16])
+    parser.add_argument("--checkpoint_stages", type=str, default=None,
+                        help="comma separated backbone stages whose activations are recomputed in the backward pass "
+                             "to save memory: layer1-layer4 (ResNet), stage2-stage4 (HRNet) or 'all' (default: None)")
 
     # Train Options
     parser.add_argument("--test_only", action='store_true', default=False)
     parser.add_argument("--save_val_results", action='store_true', default=False,
                         help="save segmentation results to \"./results\"")
+    parser.add_argument("--save_workers", type=int, default=2,
+                        help="number of processes writing --save_val_results (default: 2)")
     parser.add_argument("--total_itrs", type=int, default=100e3,
                         help="epoch number (default: 30k)")
     parser.add_argument("--lr", type=float, default=0.01,
@@ -60,24 +87,46 @@ def get_argparser():
                         help='crop validation (default: False)')
     parser.add_argument("--batch_size", type=int, default=6,
                         help='batch size (default: 16)')
+    parser.add_argument("--accum_steps", type=int, default=1,
+                        help="accumulate gradients over this many batches per optimizer step, "
+                             "the effective batch size is batch_size * accum_steps (default: 1)")
     parser.add_argument("--val_batch_size", type=int, default=6,
                         help='batch size for validation (default: 4)')
     parser.add_argument("--crop_size", type=int, default=768)
+    parser.add_argument("--batch_transforms", action='store_true', default=False,
+                        help="run train augmentation on whole batches on the training device (cityscapes only)")
+    parser.add_argument("--channels_last", action='store_true', default=False,
+                        help="keep the weights and the image batches in channels-last (NHWC) memory format")
+    parser.add_argument("--amp", action='store_true', default=False,
+                        help="mixed precision training and validation (bfloat16 on CPU, float16 on CUDA)")
 
     parser.add_argument("--ckpt", default=None, type=str,
                         help="restore from checkpoint")
     parser.add_argument("--continue_training", action='store_true', default=False)
+    parser.add_argument("--ckpt_keep", type=int, default=1,
+                        help="number of latest checkpoints kept, older ones are deleted; with more than 1 "
+                             "the file names include the iteration (default: 1)")
 
     parser.add_argument("--loss_type", type=str, default='cross_entropy',
                         choices=['cross_entropy', 'focal_loss'], help="loss type (default: False)")
     parser.add_argument("--gpu_id", type=str, default='0',
                         help="GPU ID")
+    parser.add_argument("--dist_backend", type=str, default='gloo', choices=['gloo', 'nccl'],
+                        help="torch.distributed backend when launched with torchrun (default: gloo)")
     parser.add_argument("--weight_decay", type=float, default=5e-4,
                         help='weight decay (default: 1e-4)')
     parser.add_argument("--random_seed", type=int, default=10,
                         help="random seed (default: 1)")
     parser.add_argument("--print_interval", type=int, default=10,
                         help="print interval of loss (default: 10)")
+    parser.add_argument("--profile", action='store_true', default=False,
+                        help="print and log the time per iteration of data loading, copies, forward, loss, "
+                             "backward, optimizer step and logging, and the forward time of the backbone, "
+                             "ASPP and head, every --print_interval iterations")
+    parser.add_argument("--profile_window", type=int, nargs=2, default=None, metavar=('START', 'END'),
+                        help="write a torch.profiler trace of iterations START to END (default: None)")
+    parser.add_argument("--profile_dir", type=str, default='profiles',
+                        help="directory of the profiler traces (default: ./profiles)")
     parser.add_argument("--val_interval", type=int, default=5000,
                         help="epoch interval for eval (default: 100)")
     parser.add_argument("--download", action='store_true', default=False,
@@ -99,6 +148,68 @@ def get_argparser():
     return parser
 
 
+def get_label_cache(opts, dataset, split):
+    """ path of the label cache written by cache_labels.py, if any
+    """
+    if opts.label_cache_dir is None:
+        return None
+    path = os.path.join(opts.label_cache_dir, '%s_%s.labels' % (dataset, split))
+    if not os.path.isfile(path):
+        print("[!] No label cache at %s, decoding labels from PNG" % path)
+        return None
+    return path
+
+
+def get_root_tag(opts):
+    """ short hash of --data_root, so that datasets at different paths do not share
+    the files written to --manifest_dir
+    """
+    return hashlib.sha1(os.path.abspath(opts.data_root).encode()).hexdigest()[:8]
+
+
+def get_manifest(opts, dataset, split):
+    """ path of the manifest for a dataset split, built on first use
+    """
+    if opts.manifest_dir is None:
+        return None
+    os.makedirs(opts.manifest_dir, exist_ok=True)
+    return os.path.join(opts.manifest_dir, '%s_%s_%s.json' % (dataset, split, get_root_tag(opts)))
+
+
+def get_rare_classes(opts):
+    """ train ids of the classes named by --rare_classes
+    """
+    names = {c.name: c.train_id for c in GTA.classes}
+    rare = []
+    for name in opts.rare_classes.split(','):
+        name = name.strip()
+        rare.append(int(name) if name.isdigit() else names[name])
+    return rare
+
+
+def get_train_sampler(opts, train_dst):
+    """ rare-class-aware sampler for --rare_class_sampling, None for plain shuffling
+    """
+    if not opts.rare_class_sampling:
+        return None
+    if isinstance(train_dst, data.IterableDataset):
+        raise ValueError('--rare_class_sampling needs random access and does not work with --shard_root')
+    path = opts.class_index
+    if path is None:
+        if opts.manifest_dir is not None:
+            path = os.path.join(opts.manifest_dir, 'class_index_gta_all_%s.npy' % get_root_tag(opts))
+        else:
+            path = os.path.join(opts.data_root, 'class_index_gta_all.npy')
+        if not os.path.isfile(path) and not os.access(os.path.dirname(path), os.W_OK):
+            # read-only dataset, keep the index next to the checkpoints
+            path = os.path.join('checkpoints', 'class_index_gta_all.npy')
+            os.makedirs('checkpoints', exist_ok=True)
+    # built by the first process, the others wait for it
+    class_counts = load_or_build_class_index(path, train_dst, opts.num_classes, build=is_main_process())
+    return RareClassSampler(class_counts, get_rare_classes(opts), boost=opts.rare_class_boost,
+                            seed=opts.random_seed)
+
+
 def get_dataset(opts):
     """ Dataset And Augmentation
     """
@@ -132,15 +243,27 @@ def get_dataset(opts):
                                   image_set='val', download=False, transform=val_transform)
 
     if opts.dataset == 'cityscapes':
-        train_transform = et.ExtCompose([
-            et.ExtResize(size= (1914,1052) ),
-            et.ExtRandomCrop(size=(768,768)),
-           # et.ExtColorJitter(brightness=0.5, contrast=0.5, saturation=0.5),
-            et.ExtRandomHorizontalFlip(),
-            et.ExtToTensor(),
-            et.ExtNormalize(mean=[0.485, 0.456, 0.406],
-                            std=[0.229, 0.224, 0.225]),
-        ])
+        train_resize = et.ExtResize(size= (1914,1052) )
+        train_label_cache = get_label_cache(opts, 'gta', 'all')
+        focus_ids = None
+        if opts.rare_class_sampling:
+            # the crop sees train ids when labels come from the cache, raw ids otherwise
+            focus_ids = get_rare_classes(opts)
+            if train_label_cache is None:
+                focus_ids = [c.id for c in GTA.classes if c.train_id in focus_ids]
+
+        def make_train_transform(focus_ids=None):
+            return et.ExtCompose([
+                train_resize,
+                et.ExtRandomCrop(size=(768,768), focus_ids=focus_ids, focus_prob=opts.focus_crop_prob),
+               # et.ExtColorJitter(brightness=0.5, contrast=0.5, saturation=0.5),
+                et.ExtRandomHorizontalFlip(),
+                et.ExtToTensor(),
+                et.ExtNormalize(mean=[0.485, 0.456, 0.406],
+                                std=[0.229, 0.224, 0.225]),
+            ])
+        train_transform = make_train_transform(focus_ids)
+        eval_transform = make_train_transform() if focus_ids is not None else train_transform
      
         val_transform = et.ExtCompose([
             et.ExtResize( (768,768)  ),
@@ -148,27 +271,67 @@ def get_dataset(opts):
             et.ExtNormalize(mean=[0.485, 0.456, 0.406],
                             std=[0.229, 0.224, 0.225]),
         ])
-
-        train_dst = GTA(root=opts.data_root,
-                               split='all', transform=train_transform)
+        resize_cache = None
+        if opts.resize_cache_dir is not None:
+            # the fixed resize is served by the cache, only the random part of the pipeline runs per epoch
+            resize_cache = ResizeCache(opts.resize_cache_dir, train_resize)
+            train_transform = et.ExtCompose(train_transform.transforms[1:])
+            eval_transform = et.ExtCompose(eval_transform.transforms[1:])
+        # with --batch_transforms the augmentation runs on collated batches, see get_batch_transform
+        dst_train_transform = et.ExtCompose([et.ExtPILToTensor()]) if opts.batch_transforms else train_transform
+
+        if opts.shard_root is not None:
+            train_dst = ShardedSegmentationDataset(root=opts.shard_root, transform=dst_train_transform,
+                                                   encode_target=GTA.encode_target,
+                                                   decode_target=GTA.decode_target,
+                                                   seed=opts.random_seed)
+        else:
+            train_dst = GTA(root=opts.data_root,
+                               split='all', transform=dst_train_transform,
+                               label_cache=train_label_cache, resize_cache=resize_cache,
+                               manifest=get_manifest(opts, 'gta', 'all'))
         # val_dst = Cityscapes(root='/media/fahad/Crucial X81/datasets/cityscapes/',
         #                 split='val', transform=val_transform)
         val_dst = GTA(root=opts.data_root,
-                               split='val', transform=train_transform)
+                               split='val', transform=eval_transform,
+                               label_cache=get_label_cache(opts, 'gta', 'val'), resize_cache=resize_cache,
+                               manifest=get_manifest(opts, 'gta', 'val'))
         # val_dst = GTAV(root='/media/fahad/Crucial X8/gta5/gta/',
         #                      split='sub_bdd', transform=val_transform)
     return train_dst, val_dst
 
+def get_batch_transform(opts):
+    """ Augmentation applied to whole training batches after collation, see --batch_transforms
+    """
+    if not opts.batch_transforms:
+        return None
+    if opts.dataset != 'cityscapes':
+        raise ValueError('--batch_transforms needs equally sized images and is only supported for cityscapes')
+    # the collated labels are train ids, the rare class crops center on those
+    focus_ids = get_rare_classes(opts) if opts.rare_class_sampling else None
+    return et.ExtBatchCompose([
+        et.ExtBatchResize(size=(1914, 1052)),
+        et.ExtBatchRandomCrop(size=(768, 768), focus_ids=focus_ids, focus_prob=opts.focus_crop_prob),
+        # et.ExtBatchColorJitter(brightness=0.5, contrast=0.5, saturation=0.5),
+        et.ExtBatchRandomHorizontalFlip(),
+        et.ExtBatchNormalize(mean=[0.485, 0.456, 0.406],
+                             std=[0.229, 0.224, 0.225]),
+    ])
+
 def add_gta_infos_in_tensorboard(writer,imgs,labels,outputs,cur_itrs,denorm,train_loader):
-        img=imgs[0].detach().cpu().numpy()
-        img=(denorm(img)*255).astype(np.uint8)
-        writer.add_image('gta_image',img,cur_itrs,dataformats='CHW')
-        lbs=labels[0].detach().cpu().numpy()
-        lbs=train_loader.dataset.decode_target(lbs).astype('uint8')
-        writer.add_image('gta_ground_truth',lbs,cur_itrs,dataformats='HWC')
-        pred=outputs.detach().max(1)[1].cpu().numpy()
-        pred = train_loader.dataset.decode_target(pred[0]).astype('uint8')
-        writer.add_image('gta_pred',pred,cur_itrs,dataformats='HWC')
+        if writer is None:  # not the first process
+            return
+        decode_target = train_loader.dataset.decode_target
+
+        # runs on the logging thread
+        def write(writer, img, lbs, pred):
+            img=(denorm(img)*255).astype(np.uint8)
+            writer.add_image('gta_image',img,cur_itrs,dataformats='CHW')
+            lbs=decode_target(lbs)
+            writer.add_image('gta_ground_truth',lbs,cur_itrs,dataformats='HWC')
+            pred = decode_target(pred)
+            writer.add_image('gta_pred',pred,cur_itrs,dataformats='HWC')
+        writer.submit(write, imgs[0], labels[0].byte(), outputs[0].detach().argmax(0).byte())
         
 def add_cs_in_tensorboard(writer,imgs,labels,outputs,cur_itrs,denorm,train_loader,i):
     if imgs[i] == None :
@@ -196,17 +359,35 @@ def create_colormap(feat):
 
     feat_map=(feat_map*255).astype(np.uint8)
     return feat_map
-def validate(opts, model, loader, device, metrics,denorm=None,writer=None, cur_itrs=0,ret_samples_ids=None):
+def get_amp(opts, device):
+    """ autocast dtype and gradient scaler for --amp.
+    float16 gradients may underflow and are scaled on CUDA, bfloat16 has the range of float32 and needs no scaling
+    """
+    amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    scaler = torch.amp.GradScaler(device.type, enabled=opts.amp and device.type == 'cuda')
+    return amp_dtype, scaler
+
+def get_exporter(opts, loader):
+    """ the writer of --save_val_results, shared by every validation of the run """
+    if not opts.save_val_results:
+        return None
+    # the loader may iterate over a Subset when the evaluation is sharded
+    decode_target = getattr(loader.dataset, 'dataset', loader.dataset).decode_target
+    # PNG encoding and overlays run in worker processes while evaluation goes on
+    return utils.ResultExporter('results', decode_target, num_workers=opts.save_workers)
+
+def validate(opts, model, loader, device, metrics,denorm=None,writer=None, cur_itrs=0,ret_samples_ids=None,
+             exporter=None):
     """Do validation and return specified samples"""
     metrics.reset()
     ret_samples = []
-    if opts.save_val_results:
-        if not os.path.exists('results'):
-            os.mkdir('results')
+    if exporter is not None:
         denorm = utils.Denormalize(mean=[0.485, 0.456, 0.406],
                                    std=[0.229, 0.224, 0.225])
-        img_id = 0
+        # ranks number their results in an interleaved way so that file names do not collide
+        img_id = get_rank()
 
+    amp_dtype, _ = get_amp(opts, device)
     with torch.no_grad():
         for i, (images, labels) in tqdm(enumerate(loader)):
 
@@ -214,42 +395,32 @@ def validate(opts, model, loader, device, metrics,denorm=None,writer=None, cur_i
             labels = labels.to(device, dtype=torch.long)
 
 
-            outputs,_ = model(images)
-            preds = outputs.detach().max(dim=1)[1].cpu().numpy()
-            targets = labels.cpu().numpy()
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=opts.amp):
+                outputs,_ = model(images)
+            preds = outputs.detach().max(dim=1)[1]
 
-            metrics.update(targets, preds)
+            # the confusion matrix is accumulated on the device, label maps only
+            # go to the host when samples are kept or saved
+            metrics.update(labels, preds)
             # if i <4 :
             #     add_cs_in_tensorboard(writer,images,labels,outputs,cur_itrs,denorm,loader,i)
             if ret_samples_ids is not None and i in ret_samples_ids:  # get vis samples
                 ret_samples.append(
-                    (images[0].detach().cpu().numpy(), targets[0], preds[0]))
+                    (images[0].detach().cpu().numpy(), labels[0].cpu().numpy(), preds[0].cpu().numpy()))
 
-            if opts.save_val_results:
+            if exporter is not None:
+                # denormalized as a batch on the device, uint8 keeps the transfers to the workers small
+                images_np = (denorm(images) * 255).clamp(0, 255).byte().permute(0, 2, 3, 1).cpu().numpy()
+                targets = labels.byte().cpu().numpy()
+                preds = preds.byte().cpu().numpy()
                 for i in range(len(images)):
-                    image = images[i].detach().cpu().numpy()
-                    target = targets[i]
-                    pred = preds[i]
-
-                    image = (denorm(image) * 255).transpose(1, 2, 0).astype(np.uint8)
-                    target = loader.dataset.decode_target(target).astype(np.uint8)
-                    pred = loader.dataset.decode_target(pred).astype(np.uint8)
-
-                    Image.fromarray(image).save('results/%d_image.png' % img_id)
-                    Image.fromarray(target).save('results/%d_target.png' % img_id)
-                    Image.fromarray(pred).save('results/%d_pred.png' % img_id)
-
-                    fig = plt.figure()
-                    plt.imshow(image)
-                    plt.axis('off')
-                    plt.imshow(pred, alpha=0.7)
-                    ax = plt.gca()
-                    ax.xaxis.set_major_locator(matplotlib.ticker.NullLocator())
-                    ax.yaxis.set_major_locator(matplotlib.ticker.NullLocator())
-                    plt.savefig('results/%d_overlay.png' % img_id, bbox_inches='tight', pad_inches=0)
-                    plt.close()
-                    img_id += 1
+                    exporter.add(img_id, images_np[i], targets[i], preds[i])
+                    img_id += get_world_size()
 
+        if exporter is not None:
+            exporter.wait()
+        # each rank has seen its own slice of the validation set
+        metrics.all_reduce()
         score = metrics.get_results()
     return score, ret_samples
 
@@ -267,13 +438,52 @@ def add_feats(writer,feats,name,cur_itrs):
             # f_b= (f_b-f_b.min())/(f_b.max()-f_b.min())         
             # writer.add_image('feat_backbone_l2_'+name,create_colormap(f_b.detach().cpu().numpy()),cur_itrs,dataformats='HWC')
 def writer_add_features(writer, name, tensor_feat, iterations):
-    feat_img = tensor_feat[0].detach().cpu().numpy()
-    # img_grid = self.make_grid(feat_img)
-    feat_img = np.sum(feat_img,axis=0)
-    feat_img = feat_img -np.min(feat_img)
-    img_grid = 255*feat_img/np.max(feat_img)
-    img_grid = cv2.applyColorMap(np.array(img_grid, dtype=np.uint8), cv2.COLORMAP_JET)
-    writer.add_image(name, img_grid, iterations, dataformats='HWC')
+    # runs on the logging thread
+    def write(writer, feat_img):
+        # img_grid = self.make_grid(feat_img)
+        feat_img = np.sum(feat_img,axis=0)
+        feat_img = feat_img -np.min(feat_img)
+        img_grid = 255*feat_img/np.max(feat_img)
+        img_grid = cv2.applyColorMap(np.array(img_grid, dtype=np.uint8), cv2.COLORMAP_JET)
+        writer.add_image(name, img_grid, iterations, dataformats='HWC')
+    writer.submit(write, tensor_feat[0])
+def log_timings(writer, timer, module_timer, cur_itrs):
+    """ print and log the ms per iteration of every stage and module since the last call,
+    and the share of the iteration spent waiting for the loader; validation is left out
+    of the total
+    """
+    module_times = module_timer.summary(timer.steps)
+    stage_times = timer.summary()
+    total = sum(t for name, t in stage_times.items() if name != 'validation')
+    data_share = stage_times.get('data', 0.0) / total if total > 0 else 0.0
+    if is_main_process():
+        print("  time/itr %.1f ms: %s | data wait %.0f%% (%s-bound)" % (
+            total, ', '.join('%s %.1f' % (name, t) for name, t in stage_times.items()),
+            100 * data_share, 'input' if data_share > 0.5 else 'compute'))
+        print("  forward: %s" % ', '.join('%s %.1f ms' % (name, t) for name, t in module_times.items()))
+    if writer is not None:
+        for name, t in stage_times.items():
+            writer.add_scalar('time/%s' % name, t, cur_itrs)
+        writer.add_scalar('time/total', total, cur_itrs)
+        writer.add_scalar('time/data_share', data_share, cur_itrs)
+        for name, t in module_times.items():
+            writer.add_scalar('time_module/%s' % name, t, cur_itrs)
+
+
+def wrap_model(model, device, distributed):
+    """ DistributedDataParallel when launched with torchrun, DataParallel otherwise.
+    Both expose the wrapped network as ``model.module``.
+    """
+    model.to(device)
+    if distributed:
+        if hasattr(model.backbone, 'fc'):
+            # the classification layer of the ResNet backbones never gets a gradient,
+            # DDP would wait for it forever
+            model.backbone.fc.requires_grad_(False)
+        return nn.parallel.DistributedDataParallel(
+            model, device_ids=[device.index] if device.type == 'cuda' else None)
+    return nn.DataParallel(model)
+
 def main():
     opts = get_argparser().parse_args()
     if opts.dataset.lower() == 'voc':
@@ -281,32 +491,50 @@ def main():
     elif opts.dataset.lower() == 'cityscapes':
         opts.num_classes = 19
 
-    # Setup visualization
+    os.environ['CUDA_VISIBLE_DEVICES'] = opts.gpu_id
+    # with torchrun --nproc_per_node=N every process trains on 1/N of each epoch
+    # and evaluates 1/N of the validation set
+    distributed = init_distributed(opts.dist_backend)
+    if torch.cuda.is_available():
+        device = torch.device('cuda', torch.cuda.current_device())
+    else:
+        device = torch.device('cpu')
+    print("Device: %s, rank %d/%d" % (device, get_rank(), get_world_size()))
+
+    # Setup visualization, only on the first process
     vis = Visualizer(port=opts.vis_port,
-                     env=opts.vis_env) if opts.enable_vis else None
+                     env=opts.vis_env) if opts.enable_vis and is_main_process() else None
     if vis is not None:  # display options
         vis.vis_table("Options", vars(opts))
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = opts.gpu_id
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print("Device: %s" % device)
-
-    # Setup random seed
-    torch.manual_seed(opts.random_seed)
-    np.random.seed(opts.random_seed)
-    random.seed(opts.random_seed)
-    writer = SummaryWriter("/media/fahad/DATA_2/test")
+    # Setup random seed, different augmentations on every process
+    torch.manual_seed(opts.random_seed + get_rank())
+    np.random.seed(opts.random_seed + get_rank())
+    random.seed(opts.random_seed + get_rank())
+    # images, histograms and scalars are written by a background thread
+    writer = utils.AsyncSummaryWriter(SummaryWriter("/media/fahad/DATA_2/test")) if is_main_process() else None
 
     # Setup dataloader
     if opts.dataset == 'voc' and not opts.crop_val:
         opts.val_batch_size = 1
 
     train_dst, val_dst = get_dataset(opts)
+    batch_transform = get_batch_transform(opts)
+    train_sampler = get_train_sampler(opts, train_dst)
+    if distributed and train_sampler is None and not isinstance(train_dst, data.IterableDataset):
+        train_sampler = data.distributed.DistributedSampler(train_dst, shuffle=True, seed=opts.random_seed,
+                                                             drop_last=True)
+    # with --channels_last the loader workers convert the image batches to NHWC
+    collate_fn = utils.channels_last_collate if opts.channels_last else None
     train_loader = data.DataLoader(
-        train_dst, batch_size=opts.batch_size, shuffle=True, num_workers=2,
-        drop_last=True)  # drop_last=True to ignore single-image batches.
+        train_dst, batch_size=opts.batch_size, sampler=train_sampler,
+        shuffle=train_sampler is None and not isinstance(train_dst, data.IterableDataset),
+        num_workers=2, drop_last=True,  # drop_last=True to ignore single-image batches.
+        collate_fn=collate_fn)
+    if distributed:
+        val_dst = shard_dataset(val_dst)
     val_loader = data.DataLoader(
-        val_dst, batch_size=opts.val_batch_size, shuffle=True, num_workers=2)
+        val_dst, batch_size=opts.val_batch_size, shuffle=True, num_workers=2, collate_fn=collate_fn)
     print("Dataset: %s, Train set: %d, Val set: %d" %
           (opts.dataset, len(train_dst), len(val_dst)))
 
@@ -315,6 +543,18 @@ def main():
     if opts.separable_conv and 'plus' in opts.model:
         network.convert_to_separable_conv(model.classifier)
     utils.set_bn_momentum(model.backbone, momentum=0.01)
+    if opts.checkpoint_stages is not None:
+        stages = network.utils.set_checkpoint_stages(model, opts.checkpoint_stages.split(','))
+        print("Activation checkpointing: %s" % ', '.join(stages))
+    memory_format = torch.channels_last if opts.channels_last else torch.preserve_format
+    if opts.channels_last:
+        model = network.convert_to_channels_last(model)
+    if distributed:
+        if device.type == 'cuda':
+            # the heads see few samples per process, synchronize their statistics
+            model.classifier = nn.SyncBatchNorm.convert_sync_batchnorm(model.classifier)
+        else:
+            print("[!] SyncBatchNorm needs CUDA, BatchNorm statistics stay local to each process")
 
     # Set up metrics
     metrics = StreamSegMetrics(opts.num_classes)
@@ -337,20 +577,29 @@ def main():
         criterion = utils.FocalLoss(ignore_index=255, size_average=True)
     elif opts.loss_type == 'cross_entropy':
         criterion = nn.CrossEntropyLoss(ignore_index=255, reduction='mean')
+    amp_dtype, scaler = get_amp(opts, device)
+    if opts.amp:
+        print("Mixed precision: %s" % amp_dtype)
 
-    def save_ckpt(path):
+    # checkpoints are written on a background thread while training goes on
+    ckpt_writer = utils.AsyncCheckpointWriter(keep_last=opts.ckpt_keep)
+
+    def save_ckpt(path, group=None, pattern=None):
         """ save current model
         """
-        torch.save({
+        if not is_main_process():
+            return
+        ckpt_writer.save({
             "cur_itrs": cur_itrs,
             "model_state": model.module.state_dict(),
             "optimizer_state": optimizer.state_dict(),
             "scheduler_state": scheduler.state_dict(),
+            "scaler_state": scaler.state_dict(),
             "best_score": best_score,
-        }, path)
-        print("Model saved as %s" % path)
+        }, path, group=group, pattern=pattern)
 
-    utils.mkdir('checkpoints')
+    if is_main_process():
+        utils.mkdir('checkpoints')
     # Restore
     best_score = 0.0
     cur_itrs = 0
@@ -359,11 +608,12 @@ def main():
         # https://github.com/VainF/DeepLabV3Plus-Pytorch/issues/8#issuecomment-605601402, @PytaichukBohdan
         checkpoint = torch.load(opts.ckpt, map_location=torch.device('cpu'))
         model.load_state_dict(checkpoint["model_state"])
-        model = nn.DataParallel(model)
-        model.to(device)
+        model = wrap_model(model, device, distributed)
         if opts.continue_training:
             optimizer.load_state_dict(checkpoint["optimizer_state"])
             scheduler.load_state_dict(checkpoint["scheduler_state"])
+            if checkpoint.get("scaler_state"):  # empty when saved without float16 scaling
+                scaler.load_state_dict(checkpoint["scaler_state"])
             cur_itrs = checkpoint["cur_itrs"]
             best_score = checkpoint['best_score']
             print("Training state restored from %s" % opts.ckpt)
@@ -371,83 +621,147 @@ def main():
         del checkpoint  # free memory
     else:
         print("[!] Retrain")
-        model = nn.DataParallel(model)
-        model.to(device)
+        model = wrap_model(model, device, distributed)
 
     # ==========   Train Loop   ==========#
     vis_sample_id = np.random.randint(0, len(val_loader), opts.vis_num_samples,
                                       np.int32) if opts.enable_vis else None  # sample idxs for visualization
     denorm = utils.Denormalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])  # denormalization for ori images
 
+    exporter = get_exporter(opts, val_loader)
+
     if opts.test_only:
        #writer = SummaryWriter("/media/fahad/Crucial X8/deeplabv3plus/original_baseline/logs/R101")
 
-        # model.eval()
-        print('val len',len(val_loader))
+        # eval mode, otherwise BN statistics depend on how the validation set is batched and sharded,
+        # the validation during training uses it too
+        model.eval()
+        if is_main_process():
+            print('val len',len(val_loader))
         val_score, ret_samples = validate(
-            opts=opts, model=model, loader=val_loader, device=device, metrics=metrics, ret_samples_ids=vis_sample_id,writer=writer)
-        print(metrics.to_str(val_score))
+            opts=opts, model=model, loader=val_loader, device=device, metrics=metrics, ret_samples_ids=vis_sample_id,writer=writer,
+            exporter=exporter)
+        if is_main_process():
+            print(metrics.to_str(val_score))
+        if exporter is not None:
+            exporter.close()
         return
 
-    interval_loss = 0
+    # cur_itrs counts optimizer steps, each one accumulates the gradients of --accum_steps batches
+    if is_main_process():
+        print("Effective batch size: %d" % (opts.batch_size * opts.accum_steps * get_world_size()))
+    interval_loss = 0.0
+    tb_loss = 0.0
+    step_loss = 0.0
+    accum_itrs = 0
+    # with --profile, every stage of an iteration ends with a lap of the timer
+    sync_cuda = opts.profile and device.type == 'cuda'
+    timer = utils.StageTimer(enabled=opts.profile, sync_cuda=sync_cuda)
+    module_timer = utils.ModuleTimer(utils.get_profiled_modules(model.module),
+                                     sync_cuda=sync_cuda) if opts.profile else None
+    profiler = None
+    if opts.profile_window is not None:
+        profiler = utils.ProfilerWindow(*opts.profile_window, output_dir=opts.profile_dir, rank=get_rank(),
+                                        device=device)
+        profiler.step(cur_itrs)
+    timer.start()
     while True:  # cur_itrs < opts.total_itrs:
         # =====  Train  =====
         model.train()
         cur_epochs += 1
+        if isinstance(train_dst, ShardedSegmentationDataset):
+            train_dst.set_epoch(cur_epochs)
+        if train_sampler is not None:
+            train_sampler.set_epoch(cur_epochs)
         for (images, labels) in train_loader:
-            cur_itrs += 1
-
-            images = images.to(device, dtype=torch.float32)
+            timer.lap('data')
+            if batch_transform is not None:
+                images, labels = batch_transform(images.to(device), labels.to(device))
+                timer.lap('batch_transform')
+            images = images.to(device, dtype=torch.float32, memory_format=memory_format)
             labels = labels.to(device, dtype=torch.long)
+            timer.lap('h2d')
+
+            accum_itrs += 1
+            update = accum_itrs % opts.accum_steps == 0
+            # DDP only all-reduces the gradients in the backward pass of the last batch of a step
+            with model.no_sync() if distributed and not update else nullcontext():
+                with torch.autocast(device.type, dtype=amp_dtype, enabled=opts.amp):
+                    outputs,feat_image = model(images)
+                timer.lap('forward')
+                # log-softmax and the mean over pixels are computed in float32,
+                # the gradients of the accumulated batches are averaged
+                loss = criterion(outputs.float(), labels) / opts.accum_steps
+                timer.lap('loss')
+                scaler.scale(loss).backward()
+            step_loss += loss.item()
+            timer.lap('backward')
+            if not update:
+                continue
 
+            cur_itrs += 1
+            scaler.step(optimizer)
+            scaler.update()
             optimizer.zero_grad()
-            outputs,feat_image = model(images)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
+            timer.lap('optimizer')
 
-            np_loss = loss.detach().cpu().numpy()
+            # mean loss of the batches of this step
+            np_loss = step_loss
+            step_loss = 0.0
             interval_loss += np_loss
+            tb_loss += np_loss
 
             if vis is not None:
                 vis.vis_scalar('Loss', cur_itrs, np_loss)
 
-            if (cur_itrs) % 10 == 0:
-                interval_loss = interval_loss / 10
-                print("Epoch %d, Itrs %d/%d, Loss=%f" %
-                      (cur_epochs, cur_itrs, opts.total_itrs, interval_loss))
-                
-            if (cur_itrs) % 100 == 0: 
-                interval_loss=interval_loss/100
-                writer.add_scalar('train_image_loss', interval_loss, cur_itrs)
+            if (cur_itrs) % opts.print_interval == 0:
+                interval_loss = interval_loss / opts.print_interval
+                if is_main_process():
+                    print("Epoch %d, Itrs %d/%d, Loss=%f" %
+                          (cur_epochs, cur_itrs, opts.total_itrs, interval_loss))
                 interval_loss = 0.0
+
+            if (cur_itrs) % 100 == 0: 
+                if writer is not None:
+                    writer.add_scalar('train_image_loss', tb_loss / 100, cur_itrs)
+                tb_loss = 0.0
                 add_gta_infos_in_tensorboard(writer,images,labels,outputs,cur_itrs,denorm,train_loader)
-                writer.add_scalar('LR_Backbone',scheduler.get_lr()[0],cur_itrs)
-                writer.add_scalar('LR_classifier',scheduler.get_lr()[1],cur_itrs)
-                writer_add_features(writer,'feat_lowl_from_images',feat_image['low_level'],cur_itrs)
-                writer_add_features(writer,'feat_out_from_images',feat_image['out'],cur_itrs)
-                writer_add_features(writer,'feat_layer2_from_images',feat_image['layer2'],cur_itrs)
-                writer_add_features(writer,'feat_layer3_from_images',feat_image['layer3'],cur_itrs)
-                writer.add_histogram('low_feats',feat_image['low_level'],cur_itrs)
-                writer.add_histogram('layer2_feats',feat_image['layer2'],cur_itrs)
-                writer.add_histogram('layer3_feats',feat_image['layer3'],cur_itrs)
-                writer.add_histogram('out_feats',feat_image['out'],cur_itrs)
-               
+                if writer is not None:
+                    writer.add_scalar('LR_Backbone',scheduler.get_lr()[0],cur_itrs)
+                    writer.add_scalar('LR_classifier',scheduler.get_lr()[1],cur_itrs)
+                    # layer2 and layer3 are only returned by the ResNet backbones
+                    for key, feat_name in [('low_level', 'lowl'), ('out', 'out'), ('layer2', 'layer2'), ('layer3', 'layer3')]:
+                        if key in feat_image:
+                            writer_add_features(writer,'feat_%s_from_images' % feat_name,feat_image[key],cur_itrs)
+                    for key, hist_name in [('low_level', 'low'), ('layer2', 'layer2'), ('layer3', 'layer3'), ('out', 'out')]:
+                        if key in feat_image:
+                            writer.add_histogram('%s_feats' % hist_name,feat_image[key],cur_itrs)
+            timer.lap('logging')
+
             if (cur_itrs) % opts.val_interval == 0:
-                save_ckpt('checkpoints/latest_%s_%s_os%d.pth' %
-                          (opts.model, opts.dataset, opts.output_stride))
-                print("validation...")
-                # model.eval()
+                if opts.ckpt_keep > 1:
+                    latest = 'checkpoints/latest_%s_%s_os%d_itr%%s.pth' % (opts.model, opts.dataset, opts.output_stride)
+                    save_ckpt(latest % cur_itrs, group='latest', pattern=latest % '*')
+                else:
+                    save_ckpt('checkpoints/latest_%s_%s_os%d.pth' %
+                              (opts.model, opts.dataset, opts.output_stride))
+                if is_main_process():
+                    print("validation...")
+                # eval mode as with --test_only, validation batches must not update the BN statistics
+                model.eval()
                 val_score, ret_samples = validate(
                     opts=opts, model=model, loader=val_loader, device=device, metrics=metrics,denorm=denorm,writer=writer,cur_itrs=cur_itrs,
-                    ret_samples_ids=vis_sample_id)
-                print(metrics.to_str(val_score))
+                    ret_samples_ids=vis_sample_id, exporter=exporter)
+                if is_main_process():
+                    print(metrics.to_str(val_score))
+                # the scores are all-reduced, every process takes the same decision
                 if val_score['Mean IoU'] > best_score:  # save best model
                     best_score = val_score['Mean IoU']
                     save_ckpt('checkpoints/best_%s_%s_os%d.pth' %
                               (opts.model, opts.dataset, opts.output_stride))
-                writer.add_scalar('mIoU_cs', val_score['Mean IoU'], cur_itrs)
-                writer.add_scalar('overall_acc_cs',val_score['Overall Acc'],cur_itrs)
+                if writer is not None:
+                    writer.add_scalar('mIoU_cs', val_score['Mean IoU'], cur_itrs)
+                    writer.add_scalar('overall_acc_cs',val_score['Overall Acc'],cur_itrs)
 
                 if vis is not None:  # visualize validation score and samples
                     vis.vis_scalar("[Val] Overall Acc", cur_itrs, val_score['Overall Acc'])
@@ -456,14 +770,31 @@ def main():
 
                     for k, (img, target, lbl) in enumerate(ret_samples):
                         img = (denorm(img) * 255).astype(np.uint8)
-                        target = train_dst.decode_target(target).transpose(2, 0, 1).astype(np.uint8)
-                        lbl = train_dst.decode_target(lbl).transpose(2, 0, 1).astype(np.uint8)
+                        target = train_dst.decode_target(target).transpose(2, 0, 1)
+                        lbl = train_dst.decode_target(lbl).transpose(2, 0, 1)
                         concat_img = np.concatenate((img, target, lbl), axis=2)  # concat along width
                         vis.vis_image('Sample %d' % k, concat_img)
                 model.train()
+                timer.lap('validation')
             scheduler.step()
+            timer.lap('optimizer')
+            timer.step()
+            if profiler is not None:
+                profiler.step(cur_itrs)
+                timer.lap('logging')
+
+            if opts.profile and (cur_itrs) % opts.print_interval == 0:
+                log_timings(writer, timer, module_timer, cur_itrs)
+                timer.lap('logging')
 
             if cur_itrs >= opts.total_itrs:
+                if profiler is not None:
+                    profiler.stop()
+                ckpt_writer.close()
+                if writer is not None:
+                    writer.close()
+                if exporter is not None:
+                    exporter.close()
                 return
 
 
@@ -1,4 +1,8 @@
+import os
+
 import numpy as np
+import torch
+import torch.distributed as dist
 from sklearn.metrics import confusion_matrix
 
 class _StreamMetrics(object):
@@ -28,11 +32,25 @@ class StreamSegMetrics(_StreamMetrics):
     """
     def __init__(self, n_classes):
         self.n_classes = n_classes
-        self.confusion_matrix = np.zeros((n_classes, n_classes))
+        self.confusion_matrix = np.zeros((n_classes, n_classes), dtype=np.int64)
 
     def update(self, label_trues, label_preds):
-        for lt, lp in zip(label_trues, label_preds):
-            self.confusion_matrix += self._fast_hist( lt.flatten(), lp.flatten() )
+        """Accumulate a whole batch of (N, H, W) targets and predictions.
+
+        Both can be numpy arrays or torch tensors. Tensors on an accelerator are reduced
+        with a single ``torch.bincount`` on their own device, so only the n_classes x
+        n_classes histogram is copied to the host. CPU tensors take the numpy path,
+        which is faster than ``torch.bincount`` on CPU.
+        """
+        if torch.is_tensor(label_trues) and label_trues.device.type == 'cpu':
+            label_trues = label_trues.numpy()
+        if torch.is_tensor(label_preds) and label_preds.device.type == 'cpu':
+            label_preds = label_preds.numpy()
+        if torch.is_tensor(label_trues) or torch.is_tensor(label_preds):
+            hist = self._torch_hist(torch.as_tensor(label_trues), torch.as_tensor(label_preds))
+        else:
+            hist = self._fast_hist(np.asarray(label_trues).ravel(), np.asarray(label_preds).ravel())
+        self.confusion_matrix += hist
     
     @staticmethod
     def to_str(results):
@@ -54,6 +72,16 @@ class StreamSegMetrics(_StreamMetrics):
         ).reshape(self.n_classes, self.n_classes)
         return hist
 
+    def _torch_hist(self, label_true, label_pred):
+        label_true = label_true.reshape(-1).long()
+        label_pred = label_pred.to(label_true.device).reshape(-1).long()
+        mask = (label_true >= 0) & (label_true < self.n_classes)
+        hist = torch.bincount(
+            self.n_classes * label_true[mask] + label_pred[mask],
+            minlength=self.n_classes ** 2,
+        ).reshape(self.n_classes, self.n_classes)
+        return hist.cpu().numpy()
+
     def get_results(self):
         """Returns accuracy score evaluation result.
             - overall accuracy
@@ -80,7 +108,36 @@ class StreamSegMetrics(_StreamMetrics):
             }
         
     def reset(self):
-        self.confusion_matrix = np.zeros((self.n_classes, self.n_classes))
+        self.confusion_matrix = np.zeros((self.n_classes, self.n_classes), dtype=np.int64)
+
+    def all_reduce(self, group=None):
+        """Sum the confusion matrices of all ranks of ``group``, so that every process
+        evaluating a disjoint slice of the dataset ends up with the full result.
+        Does nothing outside of an initialized torch.distributed process group.
+        """
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        hist = torch.from_numpy(self.confusion_matrix)
+        if dist.get_backend(group) == 'nccl':
+            hist = hist.cuda()
+        dist.all_reduce(hist, op=dist.ReduceOp.SUM, group=group)
+        self.confusion_matrix = hist.cpu().numpy()
+
+    def save(self, path):
+        """ write the confusion matrix to ``path`` for a later ``merge`` """
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, self.confusion_matrix)
+        os.replace(tmp, path)
+
+    def merge(self, paths):
+        """ add the confusion matrices saved by other processes """
+        for path in paths:
+            hist = np.load(path)
+            if hist.shape != self.confusion_matrix.shape:
+                raise ValueError('%s holds a %s confusion matrix, expected %s'
+                                 % (path, hist.shape, self.confusion_matrix.shape))
+            self.confusion_matrix += hist.astype(np.int64)
 
 class AverageMeter(object):
     """Computes average values"""
@@ -1,2 +1,4 @@
 from .modeling import *
-from ._deeplab import convert_to_separable_conv
\ No newline at end of file
+from ._deeplab import convert_to_separable_conv, convert_to_channels_last
+from ._fuse import fuse_for_inference
+from ._quantize import quantize_for_inference
@@ -25,6 +25,17 @@ class DeepLabV3(_SimpleSegmentationModel):
     """
     pass
 
+def _cat(tensors, channels_last=False):
+    """ torch.cat along the channels. With ``channels_last`` (set by
+    ``convert_to_channels_last``) every branch is converted to NHWC first, otherwise a
+    single branch in NCHW (e.g. the upsampled 1x1 ASPP pooling) makes torch.cat fall
+    back to a contiguous NCHW result. The format is chosen when the model is converted,
+    not from the tensors, so that the forward stays traceable by torch.fx.
+    """
+    if channels_last:
+        tensors = [t.contiguous(memory_format=torch.channels_last) for t in tensors]
+    return torch.cat(tensors, dim=1)
+
 class DeepLabHeadV3Plus(nn.Module):
     def __init__(self, in_channels, low_level_channels, num_classes, aspp_dilate=[12, 24, 36]):
         super(DeepLabHeadV3Plus, self).__init__()
@@ -42,13 +53,19 @@ class DeepLabHeadV3Plus(nn.Module):
             nn.ReLU(inplace=True),
             nn.Conv2d(256, num_classes, 1)
         )
+        self.release_features = False
+        self.channels_last = False
         self._init_weight()
 
     def forward(self, feature):
-        low_level_feature = self.project( feature['low_level'] )
-        output_feature = self.aspp(feature['out'])
+        if self.release_features:  # take the features out of the dict so they are freed once used
+            low_level_feature = self.project( feature.pop('low_level') )
+            output_feature = self.aspp(feature.pop('out'))
+        else:
+            low_level_feature = self.project( feature['low_level'] )
+            output_feature = self.aspp(feature['out'])
         output_feature = F.interpolate(output_feature, size=low_level_feature.shape[2:], mode='bilinear', align_corners=False)
-        return self.classifier( torch.cat( [ low_level_feature, output_feature ], dim=1 ) )
+        return self.classifier( _cat( [ low_level_feature, output_feature ], self.channels_last ) )
     
     def _init_weight(self):
         for m in self.modules():
@@ -69,9 +86,12 @@ class DeepLabHead(nn.Module):
             nn.ReLU(inplace=True),
             nn.Conv2d(256, num_classes, 1)
         )
+        self.release_features = False
         self._init_weight()
 
     def forward(self, feature):
+        if self.release_features:  # take the features out of the dict so they are freed once used
+            return self.classifier( feature.pop('out') )
         return self.classifier( feature['out'] )
 
     def _init_weight(self):
@@ -153,12 +173,13 @@ class ASPP(nn.Module):
             nn.BatchNorm2d(out_channels),
             nn.ReLU(inplace=True),
             nn.Dropout(0.1),)
+        self.channels_last = False
 
     def forward(self, x):
         res = []
         for conv in self.convs:
             res.append(conv(x))
-        res = torch.cat(res, dim=1)
+        res = _cat(res, self.channels_last)
         return self.project(res)
 
 
@@ -175,4 +196,13 @@ def convert_to_separable_conv(module):
                                       module.bias)
     for name, child in module.named_children():
         new_module.add_module(name, convert_to_separable_conv(child))
-    return new_module
\ No newline at end of file
+    return new_module
+def convert_to_channels_last(model):
+    """ weights in channels-last (NHWC) memory format, and the concatenations of the heads
+    producing NHWC results
+    """
+    model = model.to(memory_format=torch.channels_last)
+    for m in model.modules():
+        if isinstance(m, (ASPP, DeepLabHeadV3Plus)):
+            m.channels_last = True
+    return model
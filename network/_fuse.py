@@ -0,0 +1,115 @@
+import copy
+
+import torch
+from torch import nn
+
+from .utils import IntermediateLayerGetter
+from ._deeplab import AtrousSeparableConvolution
+from .backbone import resnet, hrnetv2, xception
+
+
+__all__ = ["fuse_for_inference"]
+
+
+# (conv, bn) attribute pairs of modules whose forward calls the conv and then the BN
+# on its output, outside of an nn.Sequential
+_FUSE_PAIRS = {
+    resnet.BasicBlock: [('conv1', 'bn1'), ('conv2', 'bn2')],
+    resnet.Bottleneck: [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')],
+    resnet.ResNet: [('conv1', 'bn1')],
+    hrnetv2.BasicBlock: [('conv1', 'bn1'), ('conv2', 'bn2')],
+    hrnetv2.Bottleneck: [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')],
+    xception.Block: [('skip', 'skipbn')],
+}
+
+
+def _last_conv(module):
+    """ the conv producing the output of ``module``, if BN can be folded into it """
+    if isinstance(module, nn.Conv2d):
+        return module
+    if isinstance(module, xception.SeparableConv2d):
+        return module.pointwise
+    if isinstance(module, AtrousSeparableConvolution):
+        return module.body[1]
+    return None
+
+
+@torch.no_grad()
+def _fold(conv, bn):
+    """ fold ``bn`` into the weights and bias of ``conv`` """
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.affine:
+        scale = scale * bn.weight
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    bias = (bias - bn.running_mean) * scale
+    if bn.affine:
+        bias = bias + bn.bias
+    conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+    conv.bias = nn.Parameter(bias)
+
+
+def _fusable(conv, bn):
+    return (conv is not None and isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats
+            and conv.out_channels == bn.num_features)
+
+
+def _fuse_module(module):
+    """ fold the BNs of ``module`` and its children, returns the number of folded BNs """
+    fused = 0
+    if isinstance(module, (nn.Sequential, IntermediateLayerGetter)):
+        returned = getattr(module, 'return_layers', {})
+        children = list(module.named_children())
+        for (name, prev), (bn_name, bn) in zip(children[:-1], children[1:]):
+            conv = _last_conv(prev)
+            # a returned conv output would change if its BN was folded into it
+            if name not in returned and _fusable(conv, bn):
+                _fold(conv, bn)
+                setattr(module, bn_name, nn.Identity())
+                fused += 1
+    for conv_name, bn_name in _FUSE_PAIRS.get(type(module), []):
+        conv, bn = _last_conv(getattr(module, conv_name, None)), getattr(module, bn_name, None)
+        if _fusable(conv, bn):
+            _fold(conv, bn)
+            setattr(module, bn_name, nn.Identity())
+            fused += 1
+    for child in module.children():
+        fused += _fuse_module(child)
+    return fused
+
+
+def _logits(outputs):
+    return outputs[0] if isinstance(outputs, (tuple, list)) else outputs
+
+
+def fuse_for_inference(model, example_input=None, atol=1e-3):
+    """Fold every BatchNorm2d that directly follows a convolution into its weights.
+
+    Works on all DeepLab models of ``network.modeling``, including heads converted by
+    ``convert_to_separable_conv`` (the BN is folded into the pointwise conv). The input
+    model is left untouched.
+
+    Args:
+        model (nn.Module): model to fuse.
+        example_input (Tensor, optional): input used to check that the fused model gives
+            the same logits, defaults to a random 1x3x512x512 batch.
+        atol (float): largest accepted logit difference, relative to the largest logit.
+    Returns:
+        nn.Module: a fused copy of ``model`` in eval mode, without gradients.
+    """
+    fused = copy.deepcopy(model).eval()
+    _fuse_module(fused)
+    fused.requires_grad_(False)
+
+    if example_input is None:
+        param = next(model.parameters())
+        example_input = torch.randn(1, 3, 512, 512, device=param.device, dtype=param.dtype)
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        expected = _logits(model(example_input)).float()
+        actual = _logits(fused(example_input)).float()
+    model.train(training)
+    err = ((expected - actual).abs().max() / expected.abs().max().clamp(min=1e-6)).item()
+    if err > atol:
+        raise RuntimeError('Fused model differs from the original one by %g (atol=%g)' % (err, atol))
+    return fused
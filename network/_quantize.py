@@ -0,0 +1,54 @@
+import copy
+
+import torch
+import torch.nn.functional as F
+
+
+__all__ = ["quantize_for_inference"]
+
+
+def quantize_for_inference(model, calibration_data, example_input=None, backend='x86', float_upsample=True):
+    """Post-training static INT8 quantization with FX graph mode.
+
+    Observers are inserted after every quantizable op (conv+bn+relu patterns are fused
+    first), calibrated on ``calibration_data`` and replaced by quantized kernels. The
+    ``torch.cat`` of the ASPP branches and of the DeepLabV3+ decoder requantizes its
+    inputs to shared parameters, and the ``F.interpolate`` calls of the heads run on
+    quantized tensors.
+
+    Args:
+        model (nn.Module): float model of ``network.modeling``. It is not modified.
+        calibration_data (iterable): batches of normalized images, or (images, targets)
+            tuples as yielded by a DataLoader.
+        example_input (Tensor, optional): input used to trace the model, defaults to
+            the first calibration batch.
+        backend (str): quantized engine, 'x86', 'fbgemm' or 'qnnpack'.
+        float_upsample (bool): dequantize the logits before the final upsampling to the
+            input size in ``_SimpleSegmentationModel.forward``, so that the argmax is taken
+            on bilinearly interpolated float logits instead of 8 bit ones.
+    Returns:
+        torch.fx.GraphModule: quantized model, with the same outputs as ``model``.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    if float_upsample:
+        # the only interpolate called by the root module is the final one
+        qconfig_mapping.set_module_name_object_type_order('', F.interpolate, 0, None)
+
+    batches = iter(calibration_data)
+    first = next(batches)
+    first = first[0] if isinstance(first, (tuple, list)) else first
+    if example_input is None:
+        example_input = first[:1]
+
+    model = copy.deepcopy(model).cpu().eval()
+    prepared = prepare_fx(model, qconfig_mapping, (example_input,))
+    with torch.no_grad():
+        prepared(first)
+        for images in batches:
+            images = images[0] if isinstance(images, (tuple, list)) else images
+            prepared(images)
+    return convert_fx(prepared)
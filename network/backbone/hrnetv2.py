@@ -3,6 +3,8 @@ from torch import nn
 import torch.nn.functional as F
 import os
 
+from ..utils import checkpoint_module
+
 __all__ = ['HRNet', 'hrnetv2_48', 'hrnetv2_32']
 
 # Checkpoint path of pre-trained backbone (edit to your path). Download backbone pretrained model hrnetv2-32 @
@@ -147,8 +149,15 @@ class StageModule(nn.Module):
                     self.fuse_layers[-1].append(nn.Sequential(*downsampling_fusion))
 
         self.relu = nn.ReLU(inplace=True)
+        # recompute the activations of the stage in the backward pass
+        self.use_checkpoint = False
 
     def forward(self, x):
+        if self.use_checkpoint and torch.is_grad_enabled():
+            return checkpoint_module(self, *x, function=self._forward)
+        return self._forward(*x)
+
+    def _forward(self, *x):
 
         # input to each stage is a list of inputs for each branch
         x = [branch(branch_input) for branch, branch_input in zip(self.branches, x)]
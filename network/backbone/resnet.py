@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from collections import OrderedDict
+from ..utils import checkpoint_module
 try: # for torchvision<0.4
     from torchvision.models.utils import load_state_dict_from_url
 except: # for torchvision>=0.4
@@ -156,6 +157,10 @@ class ResNet(nn.Module):
         
         self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
         self.fc = nn.Linear(512 * block.expansion, num_classes)
+        # also return layer2 and layer3, set to False when only the head outputs are needed
+        self.return_intermediate = True
+        # names of the layers whose activations are recomputed in the backward pass
+        self.checkpoint_stages = set()
 
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -201,6 +206,12 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def _run_layer(self, name, x):
+        layer = getattr(self, name)
+        if name in self.checkpoint_stages and torch.is_grad_enabled():
+            return checkpoint_module(layer, x)
+        return layer(x)
+
     def forward(self, x):
         layers= OrderedDict()
         x = self.conv1(x)
@@ -208,12 +219,14 @@ class ResNet(nn.Module):
         x = self.relu(x)
         x = self.maxpool(x)
 
-        x_l1 = self.layer1(x)
-        x = self.layer2(x_l1)
-        layers['layer2'] = x
-        x = self.layer3(x)
-        layers['layer3'] = x
-        x_l4 = self.layer4(x)
+        x_l1 = self._run_layer('layer1', x)
+        x = self._run_layer('layer2', x_l1)
+        if self.return_intermediate:
+            layers['layer2'] = x
+        x = self._run_layer('layer3', x)
+        if self.return_intermediate:
+            layers['layer3'] = x
+        x_l4 = self._run_layer('layer4', x)
         layers['low_level'] = x_l1
         layers['out'] = x_l4
         return layers
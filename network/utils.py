@@ -3,21 +3,104 @@ import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
 from collections import OrderedDict
+from contextlib import nullcontext
+from torch.utils.checkpoint import checkpoint
 
 class _SimpleSegmentationModel(nn.Module):
     def __init__(self, backbone, classifier):
         super(_SimpleSegmentationModel, self).__init__()
         self.backbone = backbone
         self.classifier = classifier
-        
+        self.inference = False
+
+    def set_inference(self, mode=True):
+        """In inference mode the model returns the logits only. The backbone keeps just
+        the features used by the head, and the head drops each of them as soon as it
+        has consumed it, so that intermediate activations are freed early.
+        """
+        self.inference = mode
+        if hasattr(self.backbone, 'return_intermediate'):
+            self.backbone.return_intermediate = not mode
+        if hasattr(self.classifier, 'release_features'):
+            self.classifier.release_features = mode
+        return self
+
     def forward(self, x):
         input_shape = x.shape[-2:]
         features = self.backbone(x)
         x = self.classifier(features)
+        if self.inference:
+            del features
+            return F.interpolate(x, size=input_shape, mode='bilinear', align_corners=False)
         x = F.interpolate(x, size=input_shape, mode='bilinear', align_corners=False)
         return x,features
 
 
+class _FrozenBatchNormStats(object):
+    """ keeps the running statistics of the BatchNorm layers of ``module`` unchanged
+    (momentum 0), the batch statistics are still used for normalization. The batch
+    counters are restored too, they set the averaging factor when momentum is None.
+    """
+    def __init__(self, module):
+        self.bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+
+    def __enter__(self):
+        self.momentum = [bn.momentum for bn in self.bns]
+        self.num_batches_tracked = [bn.num_batches_tracked.clone() if bn.num_batches_tracked is not None else None
+                                    for bn in self.bns]
+        for bn in self.bns:
+            bn.momentum = 0.0
+
+    def __exit__(self, *args):
+        for bn, momentum, tracked in zip(self.bns, self.momentum, self.num_batches_tracked):
+            bn.momentum = momentum
+            if tracked is not None:
+                bn.num_batches_tracked.copy_(tracked)
+
+
+def checkpoint_module(module, *inputs, function=None):
+    """Run ``module`` (or ``function``, which uses the layers of ``module``) without
+    storing its intermediate activations, they are recomputed during the backward pass.
+    The recomputation runs BatchNorm layers in train mode a second time on the same
+    batch; their running statistics are frozen meanwhile so that they are only updated
+    once per step.
+    """
+    return checkpoint(function or module, *inputs, use_reentrant=False,
+                      context_fn=lambda: (nullcontext(), _FrozenBatchNormStats(module)))
+
+
+def set_checkpoint_stages(model, stages):
+    """Enable activation checkpointing for stages of the backbone of ``model``.
+
+    Args:
+        model (nn.Module): a model of ``network.modeling`` with a ResNet or HRNet backbone.
+        stages (list): stage names, ``layer1`` to ``layer4`` for ResNet and ``stage2`` to
+            ``stage4`` for HRNet (each StageModule is checkpointed separately), or ``['all']``. An empty list disables checkpointing.
+    Returns:
+        list: names of the checkpointed stages.
+    """
+    backbone = model.backbone
+    if hasattr(backbone, 'checkpoint_stages'):  # ResNet
+        available = ['layer1', 'layer2', 'layer3', 'layer4']
+    else:  # HRNet, stage2 to stage4 are sequences of StageModules
+        available = [name for name, m in backbone.named_children()
+                     if any(hasattr(sub, 'use_checkpoint') for sub in m.modules())]
+    if not available:
+        raise ValueError('Activation checkpointing is only supported for ResNet and HRNet backbones')
+    stages = available if list(stages) == ['all'] else list(stages)
+    for name in stages:
+        if name not in available:
+            raise ValueError('Unknown backbone stage %s, expected one of %s' % (name, ', '.join(available)))
+    if hasattr(backbone, 'checkpoint_stages'):
+        backbone.checkpoint_stages = set(stages)
+    else:
+        for name in available:
+            for stage_module in getattr(backbone, name).modules():
+                if hasattr(stage_module, 'use_checkpoint'):
+                    stage_module.use_checkpoint = name in stages
+    return stages
+
+
 class IntermediateLayerGetter(nn.ModuleDict):
     """
     Module wrapper that returns intermediate layers from a model
@@ -0,0 +1,37 @@
+import argparse
+
+from datasets import Cityscapes, GTA, GTAV, pack_shards
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description="Pack a segmentation dataset into large shard files")
+    parser.add_argument("--data_root", type=str, required=True,
+                        help="path to Dataset")
+    parser.add_argument("--dataset", type=str, default='gta',
+                        choices=['gta', 'cityscapes', 'gtav'], help='Name of dataset')
+    parser.add_argument("--split", type=str, default='all',
+                        help="split to pack (default: all)")
+    parser.add_argument("--out_dir", type=str, required=True,
+                        help="output directory for the shards")
+    parser.add_argument("--shard_size_mb", type=int, default=1024,
+                        help="approximate size of a shard in MB (default: 1024)")
+    return parser
+
+
+def main():
+    opts = get_argparser().parse_args()
+    if opts.dataset == 'gta':
+        dst = GTA(root=opts.data_root, split=opts.split)
+    elif opts.dataset == 'cityscapes':
+        dst = Cityscapes(root=opts.data_root, split=opts.split)
+    else:
+        dst = GTAV(root=opts.data_root, split=opts.split)
+
+    index = pack_shards(dst.images, dst.targets, opts.out_dir,
+                        shard_size=opts.shard_size_mb << 20)
+    print("Packed %d samples into %d shards at %s" %
+          (len(index['samples']), len(index['shards']), opts.out_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ import argparse
 import numpy as np
 
 from torch.utils import data
-from datasets import VOCSegmentation, Cityscapes, cityscapes
+from datasets import VOCSegmentation, Cityscapes, cityscapes, ImageFiles, SizeGroupedBatchSampler, read_image_sizes
 from torchvision import transforms as T
 from metrics import StreamSegMetrics
 
@@ -19,6 +19,8 @@ from PIL import Image
 import matplotlib
 import matplotlib.pyplot as plt
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 def get_argparser():
     parser = argparse.ArgumentParser()
@@ -40,16 +42,34 @@ def get_argparser():
     parser.add_argument("--separable_conv", action='store_true', default=False,
                         help="apply separable conv to decoder and aspp")
     parser.add_argument("--output_stride", type=int, default=16, choices=[8, 16])
+    parser.add_argument("--channels_last", action='store_true', default=False,
+                        help="keep the weights and the image batches in channels-last (NHWC) memory format")
+    parser.add_argument("--fuse_bn", action='store_true', default=False,
+                        help="fold BatchNorm layers into the preceding convolutions for faster inference")
 
     # Train Options
     parser.add_argument("--save_val_results_to", default=None,
                         help="save segmentation results to the specified dir")
+    parser.add_argument("--palette_png", action='store_true', default=False,
+                        help="save results as palettized PNGs whose pixels are the class indices, instead of RGB images")
 
     parser.add_argument("--crop_val", action='store_true', default=False,
                         help='crop validation (default: False)')
     parser.add_argument("--val_batch_size", type=int, default=4,
                         help='batch size for validation (default: 4)')
+    parser.add_argument("--num_workers", type=int, default=2,
+                        help='number of image decoding processes (default: 2)')
+    parser.add_argument("--save_workers", type=int, default=4,
+                        help='number of threads colorizing and writing results (default: 4)')
     parser.add_argument("--crop_size", type=int, default=513)
+    parser.add_argument("--tile_size", type=int, default=None,
+                        help="run the model on tiles of this size and blend them, for large images (default: None, whole image)")
+    parser.add_argument("--tile_overlap", type=float, default=0.25,
+                        help="fraction of a tile overlapping its neighbours (default: 0.25)")
+    parser.add_argument("--tile_batch_size", type=int, default=4,
+                        help="number of tiles per forward pass (default: 4)")
+    parser.add_argument("--tile_blend", type=str, default='gaussian', choices=['gaussian', 'linear', 'constant'],
+                        help="weighting of overlapping tile logits (default: gaussian)")
 
     
     parser.add_argument("--ckpt", default=None, type=str,
@@ -62,10 +82,10 @@ def main():
     opts = get_argparser().parse_args()
     if opts.dataset.lower() == 'voc':
         opts.num_classes = 21
-        decode_fn = VOCSegmentation.decode_target
+        palette = VOCSegmentation.palette
     elif opts.dataset.lower() == 'cityscapes':
         opts.num_classes = 19
-        decode_fn = Cityscapes.decode_target
+        palette = Cityscapes.palette
 
     os.environ['CUDA_VISIBLE_DEVICES'] = opts.gpu_id
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -91,14 +111,17 @@ def main():
         # https://github.com/VainF/DeepLabV3Plus-Pytorch/issues/8#issuecomment-605601402, @PytaichukBohdan
         checkpoint = torch.load(opts.ckpt, map_location=torch.device('cpu'))
         model.load_state_dict(checkpoint["model_state"])
-        model = nn.DataParallel(model)
-        model.to(device)
         print("Resume model from %s" % opts.ckpt)
         del checkpoint
     else:
         print("[!] Retrain")
-        model = nn.DataParallel(model)
-        model.to(device)
+    if opts.fuse_bn:
+        model = network.fuse_for_inference(model)
+    if opts.channels_last:
+        model = network.convert_to_channels_last(model)
+    model.set_inference(True)  # logits only, intermediate features are released early
+    model = nn.DataParallel(model)
+    model.to(device)
 
     #denorm = utils.Denormalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])  # denormalization for ori images
 
@@ -118,20 +141,46 @@ def main():
             ])
     if opts.save_val_results_to is not None:
         os.makedirs(opts.save_val_results_to, exist_ok=True)
-    with torch.no_grad():
+
+    # images are decoded by the loader workers and batched by size, predictions are
+    # colorized and written by a thread pool while the next batch runs
+    dataset = ImageFiles(image_files, transform=transform)
+    sizes = [None] * len(image_files) if opts.crop_val else read_image_sizes(image_files)
+    loader = data.DataLoader(dataset, batch_sampler=SizeGroupedBatchSampler(sizes, opts.val_batch_size),
+                             num_workers=opts.num_workers, pin_memory=device.type == 'cuda',
+                             collate_fn=utils.channels_last_collate if opts.channels_last else None)
+
+    def save_pred(pred, img_path):
+        ext = os.path.basename(img_path).split('.')[-1]
+        img_name = os.path.basename(img_path)[:-len(ext)-1]
+        if opts.palette_png:
+            colorized_preds = palette.to_image(pred)
+        else:
+            colorized_preds = Image.fromarray(palette.colorize(pred))
+        colorized_preds.save(os.path.join(opts.save_val_results_to, img_name+'.png'))
+
+    pending = deque()
+    with torch.no_grad(), ThreadPoolExecutor(opts.save_workers) as pool:
         model = model.eval()
-        for img_path in tqdm(image_files):
-            ext = os.path.basename(img_path).split('.')[-1]
-            img_name = os.path.basename(img_path)[:-len(ext)-1]
-            img = Image.open(img_path).convert('RGB')
-            img = transform(img).unsqueeze(0) # To tensor of NCHW
-            img = img.to(device)
-            
-            pred = model(img).max(1)[1].cpu().numpy()[0] # HW
-            colorized_preds = decode_fn(pred).astype('uint8')
-            colorized_preds = Image.fromarray(colorized_preds)
+        for img, indices in tqdm(loader):
+            img = img.to(device, non_blocking=True)
+
+            if opts.tile_size is not None:
+                outputs = utils.sliding_window_inference(model, img, opts.num_classes, tile_size=opts.tile_size,
+                                                         overlap=opts.tile_overlap,
+                                                         tile_batch_size=opts.tile_batch_size,
+                                                         blend=opts.tile_blend)
+            else:
+                outputs = model(img)
+            preds = outputs.max(1)[1].byte().cpu().numpy() # NHW, uint8 train ids
             if opts.save_val_results_to:
-                colorized_preds.save(os.path.join(opts.save_val_results_to, img_name+'.png'))
+                for pred, index in zip(preds, indices.tolist()):
+                    pending.append(pool.submit(save_pred, pred, image_files[index]))
+                # bound the number of predictions waiting to be written
+                while len(pending) > 2 * opts.save_workers * opts.val_batch_size:
+                    pending.popleft().result()
+        for future in pending:
+            future.result()
 
 if __name__ == '__main__':
     main()
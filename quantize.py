@@ -0,0 +1,152 @@
+from tqdm import tqdm
+import network
+import os
+import time
+import argparse
+import numpy as np
+
+from torch.utils import data
+from datasets import GTA, Cityscapes
+from utils import ext_transforms as et
+from metrics import StreamSegMetrics
+
+import torch
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser()
+
+    # Datset Options
+    parser.add_argument("--data_root", type=str, required=True,
+                        help="path to Dataset")
+    parser.add_argument("--dataset", type=str, default='gta',
+                        choices=['gta', 'cityscapes'], help='Name of the dataset used for calibration and evaluation')
+
+    # Deeplab Options
+    available_models = sorted(name for name in network.modeling.__dict__ if name.islower() and \
+                              not (name.startswith("__") or name.startswith('_')) and callable(
+                              network.modeling.__dict__[name])
+                              )
+    parser.add_argument("--model", type=str, default='deeplabv3plus_mobilenet',
+                        choices=available_models, help='model name')
+    parser.add_argument("--separable_conv", action='store_true', default=False,
+                        help="apply separable conv to decoder and aspp")
+    parser.add_argument("--output_stride", type=int, default=16, choices=[8, 16])
+    parser.add_argument("--ckpt", default=None, type=str,
+                        help="checkpoint to quantize")
+
+    # Quantization Options
+    parser.add_argument("--backend", type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'],
+                        help="quantized engine (default: x86)")
+    parser.add_argument("--calib_samples", type=int, default=200,
+                        help="number of validation images used for calibration (default: 200)")
+    parser.add_argument("--eval_samples", type=int, default=None,
+                        help="number of validation images used to compare mIoU (default: all)")
+    parser.add_argument("--int8_upsample", action='store_true', default=False,
+                        help="also upsample the logits to the input size in INT8")
+    parser.add_argument("--input_size", type=int, default=768,
+                        help="images are resized to input_size x input_size (default: 768)")
+    parser.add_argument("--batch_size", type=int, default=4,
+                        help='batch size for calibration and evaluation (default: 4)')
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="number of intra-op threads (default: torch default)")
+    parser.add_argument("--latency_runs", type=int, default=10,
+                        help="number of timed forward passes on a single image (default: 10)")
+    parser.add_argument("--save", type=str, default=None,
+                        help="write the quantized model as TorchScript to this path")
+    return parser
+
+
+def evaluate(model, loader, metrics):
+    metrics.reset()
+    with torch.no_grad():
+        for images, labels in tqdm(loader):
+            outputs, _ = model(images.float())
+            metrics.update(labels, outputs.max(dim=1)[1])
+    return metrics.get_results()
+
+
+def latency(model, example_input, runs):
+    """ mean and std of the forward time, in ms """
+    times = []
+    with torch.no_grad():
+        for _ in range(2):  # warm up
+            model(example_input)
+        for _ in range(runs):
+            start = time.perf_counter()
+            model(example_input)
+            times.append((time.perf_counter() - start) * 1000)
+    return np.mean(times), np.std(times)
+
+
+def main():
+    opts = get_argparser().parse_args()
+    opts.num_classes = 19
+    if opts.num_threads is not None:
+        torch.set_num_threads(opts.num_threads)
+
+    transform = et.ExtCompose([
+        et.ExtResize((opts.input_size, opts.input_size)),
+        et.ExtToTensor(),
+        et.ExtNormalize(mean=[0.485, 0.456, 0.406],
+                        std=[0.229, 0.224, 0.225]),
+    ])
+    if opts.dataset == 'gta':
+        val_dst = GTA(root=opts.data_root, split='val', transform=transform)
+    else:
+        val_dst = Cityscapes(root=opts.data_root, split='val', transform=transform)
+    # calibration and evaluation images are disjoint when the split is large enough
+    calib_dst = data.Subset(val_dst, range(min(opts.calib_samples, len(val_dst))))
+    eval_start = opts.calib_samples if opts.calib_samples < len(val_dst) else 0
+    eval_end = len(val_dst) if opts.eval_samples is None else min(eval_start + opts.eval_samples, len(val_dst))
+    eval_dst = data.Subset(val_dst, range(eval_start, eval_end))
+    calib_loader = data.DataLoader(calib_dst, batch_size=opts.batch_size, shuffle=False, num_workers=2)
+    eval_loader = data.DataLoader(eval_dst, batch_size=opts.batch_size, shuffle=False, num_workers=2)
+    print("Dataset: %s, Calibration set: %d, Evaluation set: %d" %
+          (opts.dataset, len(calib_dst), len(eval_dst)))
+
+    restore = opts.ckpt is not None and os.path.isfile(opts.ckpt)
+    # every weight comes from the checkpoint, the ImageNet backbone would only be downloaded and overwritten
+    model = network.modeling.__dict__[opts.model](num_classes=opts.num_classes, output_stride=opts.output_stride,
+                                                  pretrained_backbone=not restore)
+    if opts.separable_conv and 'plus' in opts.model:
+        network.convert_to_separable_conv(model.classifier)
+    if restore:
+        # main.py checkpoints hold numpy scalars (best_score), which weights_only loading rejects
+        checkpoint = torch.load(opts.ckpt, map_location=torch.device('cpu'), weights_only=False)
+        state_dict = checkpoint.get("model_state", checkpoint)
+        # checkpoints of a DataParallel / DistributedDataParallel model
+        state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+        model.load_state_dict(state_dict)
+        print("Model restored from %s" % opts.ckpt)
+        del checkpoint
+    else:
+        print("[!] No checkpoint, quantizing a randomly initialized head")
+    model.eval()
+
+    print("Calibrating on %d images..." % len(calib_dst))
+    quantized = network.quantize_for_inference(model, tqdm(calib_loader), backend=opts.backend,
+                                               float_upsample=not opts.int8_upsample)
+
+    metrics = StreamSegMetrics(opts.num_classes)
+    float_score = evaluate(model, eval_loader, metrics)
+    int8_score = evaluate(quantized, eval_loader, metrics)
+
+    example_input = torch.randn(1, 3, opts.input_size, opts.input_size)
+    float_ms = latency(model, example_input, opts.latency_runs)
+    int8_ms = latency(quantized, example_input, opts.latency_runs)
+
+    print("FP32: mIoU %.4f, %.1f +- %.1f ms" % (float_score['Mean IoU'], float_ms[0], float_ms[1]))
+    print("INT8: mIoU %.4f, %.1f +- %.1f ms" % (int8_score['Mean IoU'], int8_ms[0], int8_ms[1]))
+    print("mIoU delta: %+.4f, speedup: %.2fx" %
+          (int8_score['Mean IoU'] - float_score['Mean IoU'], float_ms[0] / int8_ms[0]))
+
+    if opts.save is not None:
+        with torch.no_grad():
+            scripted = torch.jit.trace(quantized, example_input, strict=False)
+        torch.jit.save(scripted, opts.save)
+        print("Quantized model saved as %s" % opts.save)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,9 @@
 from .utils import *
 from .visualizer import Visualizer
 from .scheduler import PolyLR
-from .loss import FocalLoss
\ No newline at end of file
+from .loss import FocalLoss
+from .sliding_window import sliding_window_inference
+from .checkpoint import AsyncCheckpointWriter
+from .async_writer import AsyncSummaryWriter
+from .result_exporter import ResultExporter
+from .profiling import StageTimer, ModuleTimer, ProfilerWindow, get_profiled_modules
@@ -0,0 +1,128 @@
+import queue
+import threading
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+
+class AsyncSummaryWriter(object):
+    """Front-end of a tensorboard ``SummaryWriter`` whose writes run on a worker thread.
+
+    For CUDA tensors the training thread only starts non-blocking copies into reused
+    pinned host buffers, CPU tensors are handed over without a copy and must not be
+    modified in place afterwards. Colormapping, decoding, histogram bucketing and the
+    writes themselves run on the worker. The queue is bounded: when it is full,
+    images and histograms are dropped (and counted in ``dropped``) instead of stalling
+    training, scalars wait for a free slot.
+
+    Args:
+        writer (SummaryWriter): writer used by the worker thread only.
+        max_queue (int): maximum number of pending logging calls.
+        histogram_bins (int): number of buckets of ``add_histogram``.
+    """
+    def __init__(self, writer, max_queue=16, histogram_bins=64):
+        self.writer = writer
+        self.histogram_bins = histogram_bins
+        self.dropped = 0
+        self.queue = queue.Queue(max_queue)
+        self.free_buffers = defaultdict(list)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _to_host(self, tensor):
+        """ start copying ``tensor`` to host memory, returns the host tensor """
+        tensor = tensor.detach()
+        if tensor.device.type != 'cuda':
+            return tensor
+        key = (tuple(tensor.shape), tensor.dtype)
+        with self.lock:
+            buffer = self.free_buffers[key].pop() if self.free_buffers[key] else None
+        if buffer is None:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        buffer.copy_(tensor, non_blocking=True)
+        return buffer
+
+    def _release(self, buffers):
+        with self.lock:
+            for buffer in buffers:
+                if buffer.is_pinned():
+                    self.free_buffers[(tuple(buffer.shape), buffer.dtype)].append(buffer)
+
+    def _put(self, fn, tensors, drop):
+        buffers = [self._to_host(t) for t in tensors]
+        event = None
+        if any(t.is_cuda for t in tensors):
+            event = torch.cuda.Event()
+            event.record()
+        try:
+            self.queue.put((fn, buffers, event), block=not drop)
+        except queue.Full:
+            self.dropped += 1
+            if event is not None:
+                event.synchronize()
+            self._release(buffers)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            fn, buffers, event = job
+            try:
+                if event is not None:
+                    event.synchronize()
+                # numpy has no bfloat16, autocast outputs are converted here
+                fn(self.writer, *[(b.float() if b.dtype == torch.bfloat16 else b).numpy() for b in buffers])
+            except Exception as e:  # a failed log must not stop training
+                print("[!] tensorboard logging failed: %s" % e)
+            finally:
+                self._release(buffers)
+                self.queue.task_done()
+
+    def submit(self, fn, *tensors):
+        """ call ``fn(writer, *arrays)`` on the worker thread, where ``arrays`` are host
+        copies of ``tensors`` as numpy arrays. Dropped when the queue is full.
+        """
+        self._put(fn, tensors, drop=True)
+
+    def add_scalar(self, tag, value, global_step=None):
+        value = float(value)
+        self._put(lambda writer: writer.add_scalar(tag, value, global_step), [], drop=False)
+
+    def _histogram(self, values):
+        """ min, max, sum, sum of squares and bucket counts of ``values``, without syncing """
+        values = values.float().flatten()
+        vmin, vmax = values.min(), values.max()
+        counts = torch.histc((values - vmin) / (vmax - vmin).clamp(min=1e-12),
+                             bins=self.histogram_bins, min=0, max=1)
+        return torch.stack([vmin, vmax, values.sum(), values.pow(2).sum()]), counts
+
+    def add_histogram(self, tag, values, global_step=None):
+        """ CUDA tensors are bucketed on the GPU and only the counts are copied """
+        values = values.detach()
+        num = values.numel()
+
+        def write(writer, *args):
+            if len(args) == 1:
+                stats, counts = [t.numpy() for t in self._histogram(torch.from_numpy(args[0]))]
+            else:
+                stats, counts = args
+            vmin, vmax, total, sum_squares = [float(s) for s in stats]
+            limits = np.linspace(vmin, vmax, len(counts) + 1)[1:]
+            writer.add_histogram_raw(tag, vmin, vmax, num, total, sum_squares,
+                                     limits.tolist(), counts.tolist(), global_step)
+        self._put(write, list(self._histogram(values)) if values.is_cuda else [values], drop=True)
+
+    def flush(self):
+        """ block until every queued call has been written """
+        self.queue.join()
+        self.writer.flush()
+
+    def close(self):
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
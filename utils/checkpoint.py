@@ -0,0 +1,90 @@
+import copy
+import glob
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def snapshot_to_cpu(obj):
+    """ copy of a (nested) state dict whose tensors are detached CPU copies """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def atomic_save(obj, path):
+    """ torch.save to a temporary file next to ``path``, then rename it over ``path``,
+    so that ``path`` always holds a complete checkpoint
+    """
+    tmp = '%s.tmp' % path
+    try:
+        with open(tmp, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class AsyncCheckpointWriter(object):
+    """Writes checkpoints on a background thread.
+
+    ``save`` copies the state to CPU memory on the calling thread and returns while the
+    file is written. A single writer thread serializes the writes, and a new checkpoint
+    waits for the previous one, so at most one snapshot is held in memory besides the
+    one being written. Errors of a write are raised by the next ``save``, ``wait`` or
+    ``close``.
+
+    Args:
+        keep_last (int): number of files kept per ``group`` passed to ``save``, older
+            ones are deleted once a newer one is written. The first ``save`` to a group
+            given a glob ``pattern`` also counts the files matching it that are already
+            on disk, oldest first, so that the limit holds across restarts.
+    """
+    def __init__(self, keep_last=1):
+        self.keep_last = keep_last
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.history = {}
+
+    def save(self, state, path, group=None, pattern=None):
+        """ snapshot ``state`` and write it to ``path`` in the background """
+        snapshot = snapshot_to_cpu(state)
+        self.wait()
+        self.pending = self.pool.submit(self._write, snapshot, path, group, pattern)
+
+    def _write(self, snapshot, path, group, pattern):
+        atomic_save(snapshot, path)
+        print("Model saved as %s" % path)
+        if group is None:
+            return
+        if group not in self.history:
+            existing = glob.glob(pattern) if pattern is not None else []
+            self.history[group] = deque(sorted(existing, key=lambda f: (os.path.getmtime(f), f)))
+        history = self.history[group]
+        if path in history:
+            history.remove(path)
+        history.append(path)
+        while len(history) > max(self.keep_last, 1):
+            old = history.popleft()
+            if os.path.exists(old):
+                os.remove(old)
+
+    def wait(self):
+        """ block until the last checkpoint is on disk """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
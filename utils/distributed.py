@@ -0,0 +1,45 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils import data
+
+
+def init_distributed(backend='gloo'):
+    """Join the process group described by the torchrun environment variables.
+
+    Returns:
+        bool: True if the process runs as one of several ranks.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1 or not dist.is_available():
+        return False
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)) % torch.cuda.device_count())
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def shard_dataset(dataset, rank=None, world_size=None):
+    """ disjoint, interleaved slice of ``dataset`` evaluated by this rank """
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    if world_size == 1:
+        return dataset
+    return data.Subset(dataset, range(rank, len(dataset), world_size))
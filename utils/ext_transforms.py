@@ -1,4 +1,4 @@
-import collections
+import collections.abc
 import torchvision
 import torch
 import torchvision.transforms.functional as F
@@ -336,15 +336,24 @@ class ExtRandomCrop(object):
             respectively.
         pad_if_needed (boolean): It will pad the image if smaller than the
             desired size to avoid raising an exception.
+        focus_ids (sequence, optional): label values (in the label space seen by this
+            transform) of rare classes. With probability ``focus_prob`` the crop is
+            centered on a random pixel of one of these classes, if the label has any.
+        focus_prob (float): probability of a focused crop.
     """
 
-    def __init__(self, size, padding=0, pad_if_needed=False):
+    def __init__(self, size, padding=0, pad_if_needed=False, focus_ids=None, focus_prob=0.5):
         if isinstance(size, numbers.Number):
             self.size = (int(size), int(size))
         else:
             self.size = size
         self.padding = padding
         self.pad_if_needed = pad_if_needed
+        self.focus_prob = focus_prob
+        self.focus_lut = None
+        if focus_ids is not None:
+            self.focus_lut = np.zeros(256, dtype=bool)
+            self.focus_lut[list(focus_ids)] = True
 
     @staticmethod
     def get_params(img, output_size):
@@ -364,6 +373,22 @@ class ExtRandomCrop(object):
         j = random.randint(0, w - tw)
         return i, j, th, tw
 
+    def get_focus_params(self, lbl, output_size):
+        """Get parameters for ``crop`` for a crop centered on a random rare pixel.
+        Returns:
+            tuple: params (i, j, h, w), or None if ``lbl`` has no rare pixel.
+        """
+        mask = self.focus_lut[np.asarray(lbl)]
+        candidates = np.flatnonzero(mask)
+        if len(candidates) == 0:
+            return None
+        w, h = lbl.size
+        th, tw = output_size
+        ci, cj = divmod(int(candidates[random.randrange(len(candidates))]), w)
+        i = min(max(ci - th // 2, 0), h - th)
+        j = min(max(cj - tw // 2, 0), w - tw)
+        return i, j, th, tw
+
     def __call__(self, img, lbl):
         """
         Args:
@@ -388,7 +413,12 @@ class ExtRandomCrop(object):
             img = F.pad(img, padding=int((1 + self.size[0] - img.size[1]) / 2))
             lbl = F.pad(lbl, padding=int((1 + self.size[0] - lbl.size[1]) / 2))
 
-        i, j, h, w = self.get_params(img, self.size)
+        params = None
+        if self.focus_lut is not None and random.random() < self.focus_prob:
+            params = self.get_focus_params(lbl, self.size)
+        if params is None:
+            params = self.get_params(img, self.size)
+        i, j, h, w = params
 
         return F.crop(img, i, j, h, w), F.crop(lbl, i, j, h, w)
 
@@ -409,7 +439,7 @@ class ExtResize(object):
     """
 
     def __init__(self, size, interpolation=Image.BILINEAR):
-        assert isinstance(size, int) or (isinstance(size, collections.Iterable) and len(size) == 2)
+        assert isinstance(size, int) or (isinstance(size, collections.abc.Iterable) and len(size) == 2)
         self.size = size
         self.interpolation = interpolation
 
@@ -561,3 +591,252 @@ class Compose(object):
             format_string += '    {0}'.format(t)
         format_string += '\n)'
         return format_string
+
+
+class ExtPILToTensor(object):
+    """Convert a ``PIL Image`` to a uint8 tensor of shape (C x H x W) without scaling.
+    Used in front of the batched transforms below, which do the float conversion and
+    normalization on whole batches after collation.
+    """
+    def __init__(self, target_type='uint8'):
+        self.target_type = target_type
+
+    def __call__(self, pic, lbl):
+        """
+        Args:
+            pic (PIL Image): Image to be converted to tensor.
+            lbl (PIL Image): Label to be converted to tensor.
+        Returns:
+            Tensor: uint8 image and label
+        """
+        img = torch.from_numpy(np.array(pic, dtype=np.uint8)).permute(2, 0, 1).contiguous()
+        return img, torch.from_numpy(np.array(lbl, dtype=self.target_type))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+
+#
+#  Batched Transforms for Semantic Segmentation
+#
+#  These operate jointly on a collated batch of images (N x C x H x W, uint8 or float,
+#  values in [0, 255]) and labels (N x H x W, integer train ids), on whatever device the
+#  batch lives on. Labels are always resampled with nearest neighbour and padded with
+#  ``ignore_index``. A uint8 image batch stays uint8 until ``ExtBatchNormalize``.
+#
+def _resize_batch(imgs, lbls, size):
+    dtype = imgs.dtype
+    imgs = torch.nn.functional.interpolate(imgs.float(), size=size, mode='bilinear',
+                                           align_corners=False, antialias=True)
+    if dtype == torch.uint8:
+        imgs = imgs.round_().clamp_(0, 255).to(torch.uint8)
+    lbls = torch.nn.functional.interpolate(lbls[:, None].float(), size=size,
+                                           mode='nearest-exact')[:, 0].to(lbls.dtype)
+    return imgs, lbls
+
+
+class ExtBatchCompose(ExtCompose):
+    """Composes several batched transforms together.
+    Args:
+        transforms (list of ``ExtBatch*`` objects): list of transforms to compose.
+    """
+    pass
+
+
+class ExtBatchResize(object):
+    """Resize a batch of images and labels to the given size.
+    Args:
+        size (sequence or int): Desired output size (h, w). If size is an int, the smaller
+            edge is matched to this number, keeping the aspect ratio.
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, imgs, lbls):
+        h, w = imgs.shape[-2:]
+        if isinstance(self.size, numbers.Number):
+            if h < w:
+                size = (int(self.size), int(self.size * w / h))
+            else:
+                size = (int(self.size * h / w), int(self.size))
+        else:
+            size = tuple(self.size)
+        if size == (h, w):
+            return imgs, lbls
+        return _resize_batch(imgs, lbls, size)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(size={0})'.format(self.size)
+
+
+class ExtBatchRandomScale(object):
+    """Rescale a batch by a factor drawn uniformly from ``scale_range``.
+    One factor is drawn per batch, so that the batch keeps a single shape.
+    """
+
+    def __init__(self, scale_range):
+        self.scale_range = scale_range
+
+    def __call__(self, imgs, lbls):
+        scale = random.uniform(self.scale_range[0], self.scale_range[1])
+        h, w = imgs.shape[-2:]
+        return _resize_batch(imgs, lbls, (int(h * scale), int(w * scale)))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(scale_range={0})'.format(self.scale_range)
+
+
+class ExtBatchRandomCrop(object):
+    """Crop every sample of a batch at its own random location.
+    Args:
+        size (sequence or int): Desired output size of the crop (h, w).
+        pad_if_needed (boolean): Pad images with 0 and labels with ``ignore_index``
+            when they are smaller than the crop.
+        ignore_index (int): label value used for padding.
+        focus_ids (sequence, optional): label values of rare classes, as in
+            ``ExtRandomCrop``. With probability ``focus_prob`` the crop of a sample is
+            centered on a random pixel of one of these classes, if its label has any.
+        focus_prob (float): probability of a focused crop.
+    """
+
+    def __init__(self, size, pad_if_needed=False, ignore_index=255, focus_ids=None, focus_prob=0.5):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+        self.pad_if_needed = pad_if_needed
+        self.ignore_index = ignore_index
+        self.focus_prob = focus_prob
+        self.focus_lut = None
+        if focus_ids is not None:
+            self.focus_lut = torch.zeros(256, dtype=torch.bool)
+            self.focus_lut[list(focus_ids)] = True
+
+    def get_focus_params(self, lbls, i, j):
+        """Move the crop origins ``i``, ``j`` of the samples drawn for a focused crop so
+        that the crop is centered on a random rare pixel, when the sample has one.
+        """
+        n, h, w = lbls.shape
+        th, tw = self.size
+        mask = self.focus_lut.to(lbls.device)[lbls.long()].view(n, -1)
+        found = mask.any(dim=1)
+        focused = found & (torch.rand(n, device=lbls.device) < self.focus_prob)
+        # rows without rare pixels get uniform weights, their draw is discarded
+        weights = (mask | ~found[:, None]).float()
+        index = torch.multinomial(weights, 1)[:, 0]
+        ci = (index // w - th // 2).clamp(0, h - th)
+        cj = (index % w - tw // 2).clamp(0, w - tw)
+        return torch.where(focused, ci, i), torch.where(focused, cj, j)
+
+    def __call__(self, imgs, lbls):
+        th, tw = self.size
+        h, w = imgs.shape[-2:]
+        if self.pad_if_needed and (h < th or w < tw):
+            ph, pw = max(th - h, 0), max(tw - w, 0)
+            pad = (pw // 2, pw - pw // 2, ph // 2, ph - ph // 2)
+            imgs = torch.nn.functional.pad(imgs, pad, value=0)
+            lbls = torch.nn.functional.pad(lbls, pad, value=self.ignore_index)
+            h, w = imgs.shape[-2:]
+        if h < th or w < tw:
+            raise ValueError('crop size %s is larger than the batch (%d, %d)' % (self.size, h, w))
+        if (h, w) == (th, tw):
+            return imgs, lbls
+
+        n = imgs.shape[0]
+        device = imgs.device
+        i = torch.randint(0, h - th + 1, (n,), device=device)
+        j = torch.randint(0, w - tw + 1, (n,), device=device)
+        if self.focus_lut is not None:
+            i, j = self.get_focus_params(lbls, i, j)
+        rows = (i[:, None] + torch.arange(th, device=device))[:, :, None]  # N x th x 1
+        cols = (j[:, None] + torch.arange(tw, device=device))[:, None, :]  # N x 1 x tw
+        batch = torch.arange(n, device=device)[:, None, None]
+        imgs = imgs.permute(0, 2, 3, 1)[batch, rows, cols].permute(0, 3, 1, 2).contiguous()
+        lbls = lbls[batch, rows, cols]
+        return imgs, lbls
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(size={0}, pad_if_needed={1})'.format(self.size, self.pad_if_needed)
+
+
+class ExtBatchRandomHorizontalFlip(object):
+    """Horizontally flip every sample of a batch independently with probability p.
+    """
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgs, lbls):
+        flip = torch.rand(imgs.shape[0], device=imgs.device) < self.p
+        imgs = torch.where(flip[:, None, None, None], imgs.flip(-1), imgs)
+        lbls = torch.where(flip[:, None, None], lbls.flip(-1), lbls)
+        return imgs, lbls
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(p={})'.format(self.p)
+
+
+class ExtBatchColorJitter(ExtColorJitter):
+    """Randomly change the brightness, contrast and saturation of every image in a batch.
+    Factors are drawn per sample, the order of the three adjustments per batch.
+    Arguments are the same as ``ExtColorJitter``; hue is not supported.
+    """
+    def __init__(self, brightness=0, contrast=0, saturation=0):
+        super(ExtBatchColorJitter, self).__init__(brightness, contrast, saturation)
+
+    @staticmethod
+    def _factors(bounds, n, device):
+        return torch.empty(n, 1, 1, 1, device=device).uniform_(bounds[0], bounds[1])
+
+    @staticmethod
+    def _gray(imgs):
+        r, g, b = imgs.unbind(1)
+        return (0.2989 * r + 0.587 * g + 0.114 * b)[:, None]
+
+    def __call__(self, imgs, lbls):
+        dtype = imgs.dtype
+        x = imgs.float()
+        n = x.shape[0]
+        ops = []
+        if self.brightness is not None:
+            ops.append('brightness')
+        if self.contrast is not None:
+            ops.append('contrast')
+        if self.saturation is not None:
+            ops.append('saturation')
+        random.shuffle(ops)
+        for op in ops:
+            if op == 'brightness':
+                x = x * self._factors(self.brightness, n, x.device)
+            elif op == 'contrast':
+                f = self._factors(self.contrast, n, x.device)
+                mean = self._gray(x).mean(dim=(1, 2, 3), keepdim=True)
+                x = x * f + mean * (1 - f)
+            else:
+                f = self._factors(self.saturation, n, x.device)
+                x = x * f + self._gray(x) * (1 - f)
+            x = x.clamp(0, 255)
+        if dtype == torch.uint8:
+            x = x.round_().to(torch.uint8)
+        return x, lbls
+
+
+class ExtBatchNormalize(object):
+    """Scale a batch to [0, 1] and normalize it with mean and standard deviation.
+    Args:
+        mean (sequence): Sequence of means for each channel.
+        std (sequence): Sequence of standard deviations for each channel.
+    """
+
+    def __init__(self, mean, std):
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, imgs, lbls):
+        mean = torch.as_tensor(self.mean, dtype=torch.float32, device=imgs.device).view(1, -1, 1, 1) * 255
+        std = torch.as_tensor(self.std, dtype=torch.float32, device=imgs.device).view(1, -1, 1, 1) * 255
+        return (imgs.float() - mean) / std, lbls
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+
+class StageTimer(object):
+    """Wall time of the stages of a training iteration.
+
+    ``lap(name)`` charges the time elapsed since the previous lap to ``name``, so the
+    stages of an iteration are marked by a lap at their end. A stage can be lapped
+    several times per step (e.g. the forward of each accumulated batch), its times add up.
+    ``summary`` returns the mean time per ``step`` of every stage.
+
+    Args:
+        enabled (bool): if False, ``lap`` and ``step`` do nothing.
+        sync_cuda (bool): synchronize CUDA before every lap, otherwise the time of the
+            kernels is charged to the stage that next waits for them.
+    """
+    def __init__(self, enabled=True, sync_cuda=False):
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda
+        self.totals = OrderedDict()
+        self.steps = 0
+        self.last = None
+
+    def start(self):
+        """ start the first lap """
+        if self.enabled:
+            self.last = time.perf_counter()
+
+    def lap(self, name):
+        if not self.enabled:
+            return
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        if self.last is not None:
+            self.totals[name] = self.totals.get(name, 0.0) + now - self.last
+        self.last = now
+
+    def step(self):
+        if self.enabled:
+            self.steps += 1
+
+    def summary(self, reset=True):
+        """ mean ms per step of every stage since the last reset """
+        steps = max(self.steps, 1)
+        times = OrderedDict((name, 1000 * total / steps) for name, total in self.totals.items())
+        if reset:
+            for name in self.totals:
+                self.totals[name] = 0.0
+            self.steps = 0
+        return times
+
+
+class ModuleTimer(object):
+    """Forward time of submodules, measured with forward hooks.
+
+    Only forwards with gradients enabled are timed, so that ``validate()`` does not
+    count. With ``nn.DataParallel`` on several GPUs the times of the replicas add up.
+
+    Args:
+        modules (dict): name -> module to time.
+        sync_cuda (bool): synchronize CUDA when a forward starts and ends.
+    """
+    def __init__(self, modules, sync_cuda=False):
+        self.sync_cuda = sync_cuda
+        self.totals = OrderedDict((name, 0.0) for name in modules)
+        self.starts = {}
+        self.handles = []
+        for name, module in modules.items():
+            self.handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._hook(name)))
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            if torch.is_grad_enabled():
+                self.starts[name, threading.get_ident()] = self._now()
+        return hook
+
+    def _hook(self, name):
+        def hook(module, inputs, outputs):
+            start = self.starts.pop((name, threading.get_ident()), None)
+            if start is not None:
+                self.totals[name] += self._now() - start
+        return hook
+
+    def summary(self, steps, reset=True):
+        """ mean ms per step of the forward of every module """
+        steps = max(steps, 1)
+        times = OrderedDict((name, 1000 * total / steps) for name, total in self.totals.items())
+        if reset:
+            for name in self.totals:
+                self.totals[name] = 0.0
+        return times
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def get_profiled_modules(model):
+    """ the backbone, ASPP and head of a DeepLab model, as timed by ``ModuleTimer`` """
+    modules = OrderedDict(backbone=model.backbone)
+    classifier = model.classifier
+    if hasattr(classifier, 'aspp'):  # DeepLabHeadV3Plus
+        modules['aspp'] = classifier.aspp
+    elif isinstance(getattr(classifier, 'classifier', None), torch.nn.Sequential):  # DeepLabHead
+        modules['aspp'] = classifier.classifier[0]
+    modules['classifier'] = classifier
+    return modules
+
+
+class ProfilerWindow(object):
+    """``torch.profiler`` trace of the iterations ``start`` to ``end`` (inclusive).
+
+    ``step(cur_itrs)`` is called once before training with the first iteration minus
+    one and then after every iteration. The profiler starts before iteration ``start``
+    and stops after iteration ``end``, then the trace is written to
+    ``<output_dir>/trace_itr<start>-<end>_rank<rank>.json`` (chrome://tracing or
+    https://ui.perfetto.dev), and the operators taking the most time are printed and
+    saved next to it.
+    """
+    def __init__(self, start, end, output_dir, rank=0, device=None):
+        self.start = start
+        self.end = end
+        self.output_dir = output_dir
+        self.rank = rank
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if device is not None and device.type == 'cuda':
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.sort_by = 'cuda_time_total' if len(self.activities) > 1 else 'cpu_time_total'
+        self.profiler = None
+        self.done = False
+
+    def step(self, cur_itrs):
+        if self.profiler is None and not self.done and self.start <= cur_itrs + 1 <= self.end:
+            self.profiler = torch.profiler.profile(activities=self.activities, record_shapes=True,
+                                                   profile_memory=True)
+            self.profiler.__enter__()
+        elif self.profiler is not None and cur_itrs >= self.end:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = os.path.join(self.output_dir, 'trace_itr%d-%d_rank%d' % (self.start, self.end, self.rank))
+        self.profiler.export_chrome_trace(name + '.json')
+        table = self.profiler.key_averages().table(sort_by=self.sort_by, row_limit=25)
+        with open(name + '.txt', 'w') as f:
+            f.write(table)
+        if self.rank == 0:
+            print(table)
+            print("Profiler trace saved as %s.json" % name)
+        self.profiler = None
+        self.done = True
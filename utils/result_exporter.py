@@ -0,0 +1,74 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+def blend(image, color, alpha=0.7):
+    """ ``color`` drawn over ``image`` with opacity ``alpha``, both (H, W, 3) uint8 """
+    a = int(round(alpha * 256))
+    blended = image.astype(np.uint16) * (256 - a) + color.astype(np.uint16) * a
+    return (blended >> 8).astype(np.uint8)
+
+
+def _write_sample(output_dir, img_id, image, target, pred, decode_target, alpha):
+    """ runs in a worker process """
+    target = decode_target(target)
+    pred = decode_target(pred)
+    Image.fromarray(image).save(os.path.join(output_dir, '%d_image.png' % img_id))
+    Image.fromarray(target).save(os.path.join(output_dir, '%d_target.png' % img_id))
+    Image.fromarray(pred).save(os.path.join(output_dir, '%d_pred.png' % img_id))
+    Image.fromarray(blend(image, pred, alpha)).save(os.path.join(output_dir, '%d_overlay.png' % img_id))
+
+
+class ResultExporter(object):
+    """Writes validation samples from a process pool.
+
+    For every sample, ``<id>_image.png``, ``<id>_target.png``, ``<id>_pred.png`` and
+    ``<id>_overlay.png`` (prediction colors blended over the image) are written to
+    ``output_dir``. At most ``max_pending`` samples wait for a worker, ``add`` blocks
+    on the oldest one beyond that so that memory stays bounded.
+
+    The exporter is meant to live for a whole run: ``wait`` after every validation,
+    ``close`` once at the end. The workers are started with ``mp_context`` ('spawn'
+    by default) rather than forked, since the training process runs the checkpoint
+    and tensorboard threads.
+
+    Args:
+        output_dir (str): directory of the results, created if needed.
+        decode_target (callable): maps a label map to an RGB image, must be picklable
+            (e.g. ``GTA.decode_target``).
+        num_workers (int): number of writer processes.
+        max_pending (int, optional): defaults to 4 samples per worker.
+        alpha (float): opacity of the prediction in the overlay.
+        mp_context (str): start method of the workers, 'spawn' or 'forkserver'.
+    """
+    def __init__(self, output_dir, decode_target, num_workers=2, max_pending=None, alpha=0.7,
+                 mp_context='spawn'):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.decode_target = decode_target
+        self.alpha = alpha
+        self.max_pending = max_pending or 4 * num_workers
+        self.pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context(mp_context))
+        self.pending = deque()
+
+    def add(self, img_id, image, target, pred):
+        """ queue one sample: (H, W, 3) uint8 image, (H, W) target and prediction """
+        self.pending.append(self.pool.submit(_write_sample, self.output_dir, img_id, image, target, pred,
+                                             self.decode_target, self.alpha))
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft().result()
+
+    def wait(self):
+        """ wait until every sample is written """
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        """ wait for the pending samples and stop the workers """
+        self.wait()
+        self.pool.shutdown()
@@ -0,0 +1,86 @@
+import math
+
+import torch
+
+
+def _tile_starts(size, tile, stride):
+    """ start offsets of the tiles covering ``range(size)``, the last tile ends at ``size`` """
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+    return starts
+
+
+def blend_window(height, width, mode='gaussian', device=None):
+    """Weights given to the logits of a (height, width) tile.
+
+    ``gaussian`` uses sigma = 1/8 of the tile side, ``linear`` a pyramid falling
+    towards the borders, ``constant`` a plain average. The weights never reach zero
+    so that pixels near the image border, which only one tile covers, stay defined.
+    """
+    def ramp(n):
+        x = torch.arange(n, dtype=torch.float32, device=device) + 0.5
+        if mode == 'gaussian':
+            sigma = n / 8.0
+            w = torch.exp(-0.5 * ((x - n / 2.0) / sigma) ** 2)
+        elif mode == 'linear':
+            w = 1.0 - (x - n / 2.0).abs() / (n / 2.0)
+        elif mode == 'constant':
+            w = torch.ones(n, device=device)
+        else:
+            raise ValueError('Unknown blend mode %s' % mode)
+        return w.clamp(min=1e-3)
+    return ramp(height)[:, None] * ramp(width)[None, :]
+
+
+def sliding_window_inference(model, images, num_classes, tile_size=512, overlap=0.25,
+                             tile_batch_size=4, blend='gaussian'):
+    """Segment ``images`` tile by tile and blend the overlapping logits.
+
+    Peak activation memory depends on ``tile_size`` and ``tile_batch_size`` only; the
+    full-resolution logits and blending weights are the only buffers that grow with
+    the input.
+
+    Args:
+        model (nn.Module): segmentation model in eval mode. Models returning a tuple
+            ``(logits, features)`` are supported.
+        images (Tensor): normalized (N, C, H, W) batch.
+        num_classes (int): number of output channels.
+        tile_size (int or tuple): (h, w) of the tiles, clipped to the image size.
+        overlap (float): fraction of a tile shared with its neighbours, in [0, 1).
+        tile_batch_size (int): number of tiles run through the model at once.
+        blend (str): 'gaussian', 'linear' or 'constant' weighting of the tile logits.
+    Returns:
+        Tensor: (N, num_classes, H, W) blended logits.
+    """
+    if isinstance(tile_size, int):
+        tile_size = (tile_size, tile_size)
+    if not 0 <= overlap < 1:
+        raise ValueError('overlap must be in [0, 1), got %s' % overlap)
+    n, _, h, w = images.shape
+    th, tw = min(tile_size[0], h), min(tile_size[1], w)
+    stride_h = max(1, int(math.ceil(th * (1 - overlap))))
+    stride_w = max(1, int(math.ceil(tw * (1 - overlap))))
+    boxes = [(y, x) for y in _tile_starts(h, th, stride_h) for x in _tile_starts(w, tw, stride_w)]
+
+    window = blend_window(th, tw, blend, device=images.device)
+    logits = torch.zeros((n, num_classes, h, w), dtype=torch.float32, device=images.device)
+    weights = torch.zeros((1, 1, h, w), dtype=torch.float32, device=images.device)
+    for y, x in boxes:
+        weights[:, :, y:y + th, x:x + tw] += window
+
+    # tiles of all images go through the model together
+    tiles = [(i, y, x) for i in range(n) for (y, x) in boxes]
+    for k in range(0, len(tiles), tile_batch_size):
+        chunk = tiles[k:k + tile_batch_size]
+        batch = torch.cat([images[i:i + 1, :, y:y + th, x:x + tw] for i, y, x in chunk], dim=0)
+        outputs = model(batch)
+        if isinstance(outputs, (tuple, list)):
+            outputs = outputs[0]
+        outputs = outputs.float() * window
+        for (i, y, x), out in zip(chunk, outputs):
+            logits[i, :, y:y + th, x:x + tw] += out
+        del outputs
+    return logits / weights
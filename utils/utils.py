@@ -1,5 +1,7 @@
 from torchvision.transforms.functional import normalize
+import torch
 import torch.nn as nn
+from torch.utils.data import default_collate
 import numpy as np
 import os 
 
@@ -36,3 +38,10 @@ def fix_bn(model):
 def mkdir(path):
     if not os.path.exists(path):
         os.mkdir(path)
+
+def channels_last_collate(batch):
+    """ default_collate, with the image batch (first element) in channels-last memory
+    format. The conversion runs in the loader workers.
+    """
+    images, *rest = default_collate(batch)
+    return (images.contiguous(memory_format=torch.channels_last), *rest)